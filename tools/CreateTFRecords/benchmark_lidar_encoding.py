@@ -0,0 +1,47 @@
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from generic_tf_tools.data2example import lidar_features
+from generic_tf_tools.lidar_codec import LIDAR_ENCODINGS, DEFAULT_INT16_SCALE, parse_lidar
+from tools.DatasetViewer.lib.read import load_velodyne_scan
+
+
+def parsArgs():
+    parser = argparse.ArgumentParser(description='Compare record size and parse throughput of the lidar encodings')
+    parser.add_argument('--velodyne_file', '-v', help='Velodyne scan used for the benchmark',
+                        default='../DatasetFoggification/example_data/LidarData/2019-09-11_19-13-44_00960.bin')
+    parser.add_argument('--encodings', '-e', nargs='+', choices=LIDAR_ENCODINGS, default=LIDAR_ENCODINGS)
+    parser.add_argument('--scale', type=float, help='Quantization step of the int16 encoding', default=DEFAULT_INT16_SCALE)
+    parser.add_argument('--repeat', '-n', type=int, help='Number of timed runs per encoding', default=20)
+    return parser.parse_args()
+
+
+def main(args):
+    points = load_velodyne_scan(args.velodyne_file)
+    key = 'lidar_hdl64_strongest'
+    print('%d points' % points.shape[0])
+    print('%-10s %10s %14s %14s %12s' % ('encoding', 'bytes', 'serialize ms', 'parse ms', 'max error'))
+    for encoding in args.encodings:
+        start = time.time()
+        for _ in range(args.repeat):
+            example = tf.train.Example(features=tf.train.Features(feature=lidar_features(points, key, encoding, args.scale)))
+            serialized = example.SerializeToString()
+        serialize_time = (time.time() - start) / args.repeat
+
+        parse = tf.function(lambda x: parse_lidar(x, [key], encoding))
+        decoded = parse(tf.constant(serialized))[key].numpy()
+        start = time.time()
+        for _ in range(args.repeat):
+            parse(tf.constant(serialized))[key].numpy()
+        parse_time = (time.time() - start) / args.repeat
+
+        print('%-10s %10d %14.2f %14.2f %12.2e' % (encoding, len(serialized), serialize_time * 1000, parse_time * 1000,
+                                                  np.max(np.abs(decoded - points))))
+
+
+if __name__ == '__main__':
+    args = parsArgs()
+    main(args)
@@ -8,6 +8,7 @@ import os
 
 from generic_tf_tools.tf_records import TFCreator
 from generic_tf_tools.data2example import SwedenImagesv2
+from generic_tf_tools.lidar_codec import LIDAR_ENCODINGS, DEFAULT_INT16_SCALE
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(name='TfRecordsBuild')
@@ -20,9 +21,18 @@ def parsArgs():
     parser.add_argument('--file_list', '-f', help='Enter path to split files', default='DepthData')
     parser.add_argument('--dataset_type', '-t', help='Enter Dataset Type', default='FullSeeingThroughFogDataset')
     parser.add_argument('--batch_size', '-bs', type=int, help='Enter Batch Size per Record File', default=4)
+    parser.add_argument('--shard_size_mb', '-sm', type=float, help='Target size of a record file in MB, replaces --batch_size if set', default=0)
+    parser.add_argument('--lidar_encoding', '-le', choices=LIDAR_ENCODINGS, help='Storage of the point clouds, float_list or raw bytes', default='float_list')
+    parser.add_argument('--lidar_scale', type=float, help='Quantization step of the int16 lidar encoding', default=DEFAULT_INT16_SCALE)
+    parser.add_argument('--sensor_shapes', action='store_true', help='Use the fixed sensor image shapes instead of reading them from the png headers')
+    parser.add_argument('--no_radar', action='store_true', help='Do not export the radar targets')
+    parser.add_argument('--no_metadata', action='store_true', help='Do not export the CAN and weather metadata')
+    parser.add_argument('--metadata_index', help='Read the metadata from an index (see DatasetViewer/create_metadata_index.py) instead of the json files', default=None)
+    parser.add_argument('--no_resume', action='store_true', help='Ignore the manifest of a previous run and write all entries again')
     parser.add_argument('--num_threads', '-nt', type=int, help='Enter Number of Threads for parallel execution', default=1)
     parser.add_argument('--force_same_shape', '-fs', type=bool, help='Enforce same shape for all examples. Safety Feature not implemented', default=False)
     parser.add_argument('--stage', '-s', help='Stage (train, val, test)', default='train')
+    parser.add_argument('--lidar_archive_dir', '-la', help='Folder with packed lidar archives (see DatasetViewer/create_lidar_archive.py)', default=None)
     args = parser.parse_args()
     global hazed
     return args
@@ -56,7 +66,12 @@ def create_generic_db(args):
         os.makedirs(records_dir)
     conversionClass = None
     if args.dataset_type == 'FullSeeingThroughFogDataset':
-        conversionClass = SwedenImagesv2(source_dir=args.source_dir)
+        split = os.path.splitext(os.path.basename(args.file_list))[0]
+        conversionClass = SwedenImagesv2(source_dir=args.source_dir, archive_dir=args.lidar_archive_dir, split=split,
+                                         lidar_encoding=args.lidar_encoding, lidar_scale=args.lidar_scale,
+                                         image_shapes=SwedenImagesv2.sensor_shapes if args.sensor_shapes else None,
+                                         radar=not args.no_radar, metadata=not args.no_metadata,
+                                         metadata_index=args.metadata_index)
     else:
         logger.error('Wrong TF conversion Class specified')
         raise ValueError
@@ -68,7 +83,9 @@ def create_generic_db(args):
                            batch_size,
                            num_threads,
                            conversionClass,
-                           args.force_same_shape)
+                           args.force_same_shape,
+                           shard_bytes=int(args.shard_size_mb * 1e6) or None,
+                           resume=not args.no_resume)
     tf_creator()
 
     logger.info('Generic TF-DB creation Done')
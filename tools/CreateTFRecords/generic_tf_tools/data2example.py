@@ -3,6 +3,18 @@ import numpy as np
 import os
 import PIL.Image
 import json
+import struct
+import io
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from tools.DatasetViewer.lib.read import load_velodyne_scan
+from tools.DatasetViewer.lib.archive import open_lidar_archive
+from tools.DatasetViewer.lib.metadata import METADATA_FIELDS, open_metadata_index, read_sample_metadata
+from tools.DatasetViewer.lib.labels import read_label_file, parse_labels, assign_difficulty, DIFFICULTY_TO_INT, \
+    MAX_TRUNCATION, MAX_OCCLUSION, MIN_BBOX_HEIGHT
+from tools.CreateTFRecords.generic_tf_tools.lidar_codec import encode_points, DEFAULT_INT16_SCALE
 
 all_classes = []
 
@@ -31,6 +43,36 @@ def bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
 
 
+def load_json(path):
+    """Parse a json file, with orjson if it is installed"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_size(data):
+    """Return (width, height) of an encoded image, read from the PNG IHDR chunk without decoding"""
+    if data[:8] == PNG_SIGNATURE and data[12:16] == b'IHDR':
+        return struct.unpack('>II', data[16:24])
+    return PIL.Image.open(io.BytesIO(data)).size
+
+
+def lidar_features(points, key, encoding='float_list', scale=DEFAULT_INT16_SCALE):
+    """Features of one point cloud, see lidar_codec for the raw encodings"""
+    if encoding == 'float_list':
+        features = {'lidar/' + key: float_feature(points.flatten().tolist())}
+    else:
+        features = {'lidar/' + key: bytes_feature(encode_points(points, encoding, scale)),
+                    'lidar/scale/' + key: float_feature(float(scale) if encoding == 'int16' else 1.0)}
+    features['lidar/shape/' + key] = int64_feature([x for x in points.shape])
+    return features
+
+
 class labelStruct(object):
 
     def __init__(self):
@@ -59,12 +101,30 @@ class labelStruct(object):
         self.qw = []
         self.height_box = []
         self.width_box = []
+        self.difficults = []
+
+    @classmethod
+    def from_labels(cls, objects):
+        """Fill the label lists from a structured label array, see tools/DatasetViewer/lib/labels.py"""
+        o = cls()
+        o.classes = [name.encode('utf-8') for name in objects['identity'].tolist()]
+        o.truncation = objects['truncated'].tolist()
+        o.occlusion = objects['occlusion'].astype(int).tolist()
+        o.angle = objects['angle'].tolist()
+        box = np.round(np.stack([objects['xleft'], objects['ytop'], objects['xright'], objects['ybottom']])).astype(int)
+        o.xmin, o.ymin, o.xmax, o.ymax = box.tolist()
+        for name in ['height', 'width', 'length', 'posx', 'posy', 'posz', 'orient3d', 'rotx', 'roty', 'rotz', 'score',
+                     'qx', 'qy', 'qz', 'qw']:
+            setattr(o, name, objects[name].tolist())
+        o.height_box = (box[3] - box[1]).tolist()
+        o.width_box = (box[2] - box[0]).tolist()
+        return o
 
     def __truediv__(self, image_shape):
-        self.xmin = [max(0.0, min(i / image_shape[1], 1.0)) for i in self.xmin]
-        self.xmax = [max(0.0, min(i / image_shape[1], 1.0)) for i in self.xmax]
-        self.ymin = [max(0.0, min(i / image_shape[0], 1.0)) for i in self.ymin]
-        self.ymax = [max(0.0, min(i / image_shape[0], 1.0)) for i in self.ymax]
+        x = np.clip(np.array([self.xmin, self.xmax], dtype=np.float64).reshape(2, -1) / image_shape[1], 0.0, 1.0)
+        y = np.clip(np.array([self.ymin, self.ymax], dtype=np.float64).reshape(2, -1) / image_shape[0], 0.0, 1.0)
+        self.xmin, self.xmax = x.tolist()
+        self.ymin, self.ymax = y.tolist()
 
         return self
 
@@ -89,29 +149,10 @@ class dataStruct(object):
 class ExampleCreator(object):
     source_dir = None
 
-    DIFFICULTY_TO_INT = {
-        'easy': 0,
-        'moderate': 1,
-        'hard': 2
-    }
-
-    MAX_TRUNCATION = {
-        "easy": 0.15,
-        "moderate": 0.30,
-        "hard": 0.50
-    }
-
-    MAX_OCCLUSION = {
-        "easy": 0,
-        "moderate": 1,
-        "hard": 2
-    }
-
-    MIN_BBOX_HEIGHT = {
-        "easy": 40,
-        "moderate": 25,
-        "hard": 25
-    }
+    DIFFICULTY_TO_INT = DIFFICULTY_TO_INT
+    MAX_TRUNCATION = MAX_TRUNCATION
+    MAX_OCCLUSION = MAX_OCCLUSION
+    MIN_BBOX_HEIGHT = MIN_BBOX_HEIGHT
     calib = 'calib'
 
     def __init__(self):
@@ -119,20 +160,18 @@ class ExampleCreator(object):
 
     def load_velo_scan(self, file):
         """Load and parse a velodyne binary file."""
-        scan = np.fromfile(file, dtype=np.float32)
-        return scan.reshape((-1, 5))
+        return load_velodyne_scan(file)
 
     def read_radar_file(self, path):
 
-        with open(path, 'r') as f:
-            data = json.load(f)
+        data = load_json(path)
 
-        # print data
+        # the leading zero target keeps the tensor non empty for frames without targets
         data_list = [[0, 0, 0, 0, 0]]
-        for target in data['targets']:
-            data_list.append([target['x_sc'], target['y_sc'], 0, target['rVelOverGroundOdo_sc'], target['rDist_sc']])
+        data_list.extend([target['x_sc'], target['y_sc'], 0, target['rVelOverGroundOdo_sc'], target['rDist_sc']]
+                         for target in data['targets'])
 
-        targets = np.asarray(data_list)
+        targets = np.asarray(data_list, dtype=np.float32)
 
         return targets
 
@@ -145,90 +184,35 @@ class ExampleCreator(object):
 
     def proces_label(self, entry_id, image_shape):
 
-        object_list = self.get_kitti_object_list(
+        objects = self.get_kitti_object_list(
             os.path.join(self.source_dir, 'gt_labels_cmore_copied_together/cam_left_labels_TMP', entry_id + '.txt'))
 
-        o = labelStruct()
-        for object in object_list:
-            for key in object:
-                o.__getattribute__(key).append(object[key])
+        o = labelStruct.from_labels(objects)
+        o = self.process_edh(o)
         o = o.__truediv__(image_shape)
         o.print_labelStruct()
-        # o = self.process_edh(o)
 
         return o
 
-    def get_kitti_object_list(slef, label_file, camera_to_velodyne=None):
-        """Create dict for all objects of the label file, objects are labeled w.r.t KITTI definition"""
-        kitti_object_list = []
-        # print(label_file)
+    def get_kitti_object_list(slef, label_file):
+        """Read all objects of the label file into a structured array, objects are labeled w.r.t KITTI definition"""
         try:
-            with open(label_file, 'r') as file:
-                for line in file:
-                    line = line.replace('\n', '')  # remove '\n'
-                    kitti_properties = line.split(' ')
-                    all_classes.append(kitti_properties[0])
-                    object_dict = {
-                        'classes': kitti_properties[0].encode('utf-8'),
-                        'truncation': float(kitti_properties[1]),
-                        'occlusion': int(kitti_properties[2]),
-                        'angle': float(kitti_properties[3]),
-                        'xmin': int(round(float(kitti_properties[4]))),
-                        'ymin': int(round(float(kitti_properties[5]))),
-                        'xmax': int(round(float(kitti_properties[6]))),
-                        'ymax': int(round(float(kitti_properties[7]))),
-                        'height': float(kitti_properties[8]),
-                        'width': float(kitti_properties[9]),
-                        'length': float(kitti_properties[10]),
-                        'posx': float(kitti_properties[11]),
-                        'posy': float(kitti_properties[12]),
-                        'posz': float(kitti_properties[13]),
-                        'orient3d': float(kitti_properties[14]),
-                        'rotx': float(kitti_properties[15]),
-                        'roty': float(kitti_properties[16]),
-                        'rotz': float(kitti_properties[17]),
-                        'score': float(kitti_properties[18]),
-                        'qx': float(kitti_properties[19]),
-                        'qy': float(kitti_properties[20]),
-                        'qz': float(kitti_properties[21]),
-                        'qw': float(kitti_properties[22]),
-                        'height_box': int(round(float(kitti_properties[7]))) - int(round(float(kitti_properties[5]))),
-                        'width_box': int(round(float(kitti_properties[6]))) - int(round(float(kitti_properties[4]))),
-                    }
-
-                    if camera_to_velodyne is not None:
-                        pos = np.asarray([object_dict['posx'], object_dict['posy'], object_dict['posz'], 1])
-                        pos_lidar = np.matmul(camera_to_velodyne, pos.T)
-                        object_dict['posx_lidar'] = pos_lidar[0]
-                        object_dict['posy_lidar'] = pos_lidar[1]
-                        object_dict['posz_lidar'] = pos_lidar[2]
-
-                    kitti_object_list.append(object_dict)
-
-                return kitti_object_list
-
+            objects = read_label_file(label_file)
         except:
             print('Problem occurred when reading label file!')
-            return []
+            objects = parse_labels([])
+        all_classes.extend(objects['identity'].tolist())
+        return objects
 
     def process_edh(self, parsed_labels):
         """
         :return: label object with filled out diffcult level
         """
 
-        height_box = parsed_labels.height_box
-        difficults = []
-        for i in range(len(parsed_labels.xmin)):
-            truncation_lvl_item = parsed_labels.truncation[i]
-            occlusion_lvl_item = parsed_labels.occlusion[i]
-            bbox_height_item = height_box[i]
-            level = 3
-            for mode in ['hard', 'moderate', 'easy']:
-                if truncation_lvl_item <= self.MAX_TRUNCATION[mode] and occlusion_lvl_item <= self.MAX_OCCLUSION[
-                    mode] and bbox_height_item >= self.MIN_BBOX_HEIGHT[mode]:
-                    level = self.DIFFICULTY_TO_INT[mode]
-            difficults.append(level)
-        parsed_labels.difficults = difficults
+        parsed_labels.difficults = assign_difficulty(parsed_labels.truncation, parsed_labels.occlusion,
+                                                     parsed_labels.height_box, self.MAX_TRUNCATION,
+                                                     self.MAX_OCCLUSION, self.MIN_BBOX_HEIGHT,
+                                                     self.DIFFICULTY_TO_INT).tolist()
 
         return parsed_labels
 
@@ -244,9 +228,54 @@ class SwedenImagesv2(ExampleCreator):
     image_keys = ['cam_stereo_left_lut']
     point_keys = ['lidar_hdl64_last', 'lidar_hdl64_strongest']
     radar_keys = ['radar_ars300_tfl']
+    # scalar CAN and weather metadata stored as features, see METADATA_FIELDS. Missing values are stored as nan.
+    metadata_keys = dict((name, METADATA_FIELDS[name]) for name in [
+        'can/speed', 'can/steering_angle', 'can/light_sense_night', 'can/wiper', 'weather/out_temp',
+        'weather/out_humidity', 'weather/dewpoint'])
+
+    # image shapes of the sensors, used with image_shapes=SwedenImagesv2.sensor_shapes to skip reading the png headers
+    sensor_shapes = dict([(key, [720, 1280, 3]) for key in gated_keys] + [(key, [1024, 1920, 3]) for key in image_keys])
 
-    def __init__(self, source_dir=None):
+    def __init__(self, source_dir=None, archive_dir=None, split=None, lidar_encoding='float_list',
+                 lidar_scale=DEFAULT_INT16_SCALE, image_shapes=None, radar=True, metadata=True, metadata_index=None):
         self.source_dir = source_dir
+        self.radar = radar
+        self.metadata = metadata
+        # indexed samples are looked up instead of parsing their json files
+        self.metadata_index = open_metadata_index(metadata_index)
+        self.image_shapes = image_shapes or {}
+        self.lidar_encoding = lidar_encoding
+        self.lidar_scale = lidar_scale
+        # packed lidar archives per point key, frames missing in an archive are read from the .bin files
+        self.lidar_archives = {}
+        if archive_dir is not None:
+            for folder in self.point_keys:
+                archive = open_lidar_archive(archive_dir, folder, split)
+                if archive is not None:
+                    self.lidar_archives[folder] = archive
+
+    def read_png(self, folder, entry_id):
+        """Return the encoded png and its shape, taken from image_shapes if the folder is listed there"""
+        with open(os.path.join(self.source_dir, folder, entry_id + '.png'), 'rb') as f:
+            feature = f.read()
+        if folder in self.image_shapes:
+            return feature, list(self.image_shapes[folder])
+        img_width, img_height = png_size(feature)
+        return feature, [img_height, img_width, 3]
+
+    def read_metadata(self, entry_id):
+        """Read the scalar metadata from the metadata index or the json files, every file is parsed once"""
+        if self.metadata_index is not None and entry_id in self.metadata_index:
+            values = dict((name, self.metadata_index.get(entry_id, name)) for name in self.metadata_keys)
+        else:
+            values = read_sample_metadata(self.source_dir, entry_id, self.metadata_keys)
+        metadata = {}
+        for name, value in values.items():
+            try:
+                metadata[name] = float(value)
+            except (TypeError, ValueError):
+                metadata[name] = float('nan')
+        return metadata
 
     def read_data(self, entry_id, total_id):
 
@@ -256,45 +285,39 @@ class SwedenImagesv2(ExampleCreator):
         gated_images_shape = {}
         dist_lidar = {}
         dist_lidar_shape = {}
-        # @ TODO add if needed
-        # radar = {}
-        # radar_shape = {}
+        radar = {}
+        radar_shape = {}
         # read disturbed files
 
         for folder in self.image_keys:
-            file_path = os.path.join(self.source_dir, folder, entry_id + '.png')
-            feature = open(file_path, 'rb').read()
-            img = PIL.Image.open(file_path, mode="r")
-            img_width, img_height = img.size
-            dist_images[folder] = feature
-            dist_images_shape[folder] = ([img_height, img_width, 3])
+            dist_images[folder], dist_images_shape[folder] = self.read_png(folder, entry_id)
 
         for folder in self.point_keys:
-            velodyne_name = entry_id + '.bin'
-            velodyne_path = os.path.join(self.source_dir, folder, velodyne_name)
-            numpy_lidar = self.load_velo_scan(velodyne_path)
+            archive = self.lidar_archives.get(folder)
+            if archive is not None and entry_id in archive:
+                numpy_lidar = archive[entry_id]
+            else:
+                velodyne_name = entry_id + '.bin'
+                velodyne_path = os.path.join(self.source_dir, folder, velodyne_name)
+                numpy_lidar = self.load_velo_scan(velodyne_path)
             numpy_lidar_shape = numpy_lidar.shape
             dist_lidar[folder] = numpy_lidar
             dist_lidar_shape[folder] = numpy_lidar_shape
             assert len(numpy_lidar_shape) == 2
-        #
-        # @ TODO add if needed
-        # for folder in self.radar_keys:
-        #     velodyne_name = entry_id + '.json'
-        #     # velodyne_image = os.path.join(lidar_root, 'point_projected_image_yzI', 'projected', velodyne_name)
-        #     velodyne_path = os.path.join(self.source_dir, folder, velodyne_name)
-        #     numpy_radar = self.read_radar_file(velodyne_path)
-        #     radar[folder] = numpy_radar
-        #     radar_shape[folder] = numpy_radar.shape
-        #     assert len(numpy_radar.shape) == 2
+
+        if self.radar:
+            for folder in self.radar_keys:
+                radar_path = os.path.join(self.source_dir, folder, entry_id + '.json')
+                if os.path.isfile(radar_path):
+                    numpy_radar = self.read_radar_file(radar_path)
+                else:
+                    numpy_radar = np.zeros((1, 5), dtype=np.float32)
+                radar[folder] = numpy_radar
+                radar_shape[folder] = numpy_radar.shape
+                assert len(numpy_radar.shape) == 2
 
         for folder in self.gated_keys:
-            file_path = os.path.join(self.source_dir, folder, entry_id + '.png')
-            feature = open(file_path, 'rb').read()
-            img = PIL.Image.open(file_path, mode="r")
-            img_width, img_height = img.size
-            gated_images[folder] = feature
-            gated_images_shape[folder] = ([img_height, img_width, 3])
+            gated_images[folder], gated_images_shape[folder] = self.read_png(folder, entry_id)
 
         o = self.proces_label(entry_id, dist_images_shape[self.image_keys[0]])
 
@@ -302,9 +325,9 @@ class SwedenImagesv2(ExampleCreator):
         data['image_data'] = dist_images
         data['gated_data'] = gated_images
         data['lidar_data'] = dist_lidar
-        # @ TODO add if needed
-        # data['radar_data'] = radar
-        # data['radar_shape'] = radar_shape
+        data['radar_data'] = radar
+        data['radar_shape'] = radar_shape
+        data['metadata'] = self.read_metadata(entry_id) if self.metadata else {}
         data['image_shape'] = dist_images_shape
         data['lidar_shape'] = dist_lidar_shape
         data['gated_shape'] = gated_images_shape
@@ -320,7 +343,8 @@ class SwedenImagesv2(ExampleCreator):
         # print 'Doing the right stuff'
         label = data['label']
         lidar_data = data['lidar_data']
-        # radar_data = data['radar_data']
+        radar_data = data['radar_data']
+        metadata = data['metadata']
         image_data = data['image_data']
         gated_data = data['gated_data']
         image_shape = data['image_shape']
@@ -343,6 +367,7 @@ class SwedenImagesv2(ExampleCreator):
             'image/object/bbox/angle': float_feature(label.angle),
             'image/object/truncation': float_feature(label.truncation),
             'image/object/occlusion': int64_feature(label.occlusion),
+            'image/object/difficult': int64_feature(label.difficults),
             'image/object/object/bbox3d/height': float_feature(label.height),
             'image/object/bbox3d/width': float_feature(label.width),
             'image/object/bbox3d/length': float_feature(label.length),
@@ -355,12 +380,14 @@ class SwedenImagesv2(ExampleCreator):
         for key in self.image_keys:
             feature_dict['image/' + key] = bytes_feature(image_data[key])
             feature_dict['image/shape/' + key] = int64_feature([x for x in image_shape[key]])
+        feature_dict['lidar/encoding'] = bytes_feature(self.lidar_encoding.encode("utf8"))
         for idx, point_key in enumerate(self.point_keys):
-            feature_dict['lidar/' + point_key] = float_feature(lidar_data[point_key].flatten().tolist())
-            feature_dict['lidar/shape/' + point_key] = int64_feature([x for x in lidar_data[point_key].shape])
-        # for idx, radar_key in enumerate(self.radar_keys):
-        #     feature_dict['radar/'+radar_key] = float_feature(radar_data[radar_key].flatten().tolist())
-        #     feature_dict['radar/shape/'+radar_key] = int64_feature([x for x in radar_data[radar_key].shape])
+            feature_dict.update(lidar_features(lidar_data[point_key], point_key, self.lidar_encoding, self.lidar_scale))
+        for radar_key in radar_data:
+            feature_dict['radar/'+radar_key] = float_feature(radar_data[radar_key].flatten().tolist())
+            feature_dict['radar/shape/'+radar_key] = int64_feature([x for x in radar_data[radar_key].shape])
+        for name, value in metadata.items():
+            feature_dict[name] = float_feature(value)
         for key in self.gated_keys:
             feature_dict['gated/' + key] = bytes_feature(gated_data[key])
             feature_dict['gated/shape/' + key] = int64_feature([x for x in gated_shape[key]])
@@ -0,0 +1,60 @@
+"""
+Encoding of lidar point clouds in TFRecords. Besides the original float_list feature the points can be stored as one
+raw little endian bytes blob, either as float32, float16 or int16 quantized with a fixed scale.
+Each example holds 'lidar/encoding', 'lidar/<key>', 'lidar/shape/<key>' and for raw encodings 'lidar/scale/<key>'.
+"""
+import tensorflow as tf
+import numpy as np
+
+LIDAR_ENCODINGS = ['float_list', 'float32', 'float16', 'int16']
+LIDAR_DTYPES = {'float32': '<f4', 'float16': '<f2', 'int16': '<i2'}
+TF_DTYPES = {'float32': tf.float32, 'float16': tf.float16, 'int16': tf.int16}
+# 1cm resolution, covers +-327m and the intensity range 0..255
+DEFAULT_INT16_SCALE = 0.01
+
+
+def encode_points(points, encoding, scale=DEFAULT_INT16_SCALE):
+    """Return the points as raw little endian bytes, scale is only used for int16"""
+    if encoding == 'int16':
+        points = np.clip(np.round(points / scale), -32768, 32767)
+    return np.ascontiguousarray(points, dtype=LIDAR_DTYPES[encoding]).tobytes()
+
+
+def decode_points_numpy(blob, shape, encoding, scale=DEFAULT_INT16_SCALE):
+    """Numpy counterpart of decode_points, e.g. for checking records without a tf graph"""
+    points = np.frombuffer(blob, dtype=LIDAR_DTYPES[encoding]).astype(np.float32)
+    if encoding == 'int16':
+        points *= scale
+    return points.reshape(shape)
+
+
+def lidar_feature_description(point_keys, encoding):
+    """Feature description of the lidar features for tf.io.parse_single_example"""
+    features = {}
+    for key in point_keys:
+        if encoding == 'float_list':
+            features['lidar/' + key] = tf.io.VarLenFeature(tf.float32)
+        else:
+            features['lidar/' + key] = tf.io.FixedLenFeature([], tf.string)
+            features['lidar/scale/' + key] = tf.io.FixedLenFeature([], tf.float32, default_value=1.0)
+        features['lidar/shape/' + key] = tf.io.FixedLenFeature([2], tf.int64)
+    return features
+
+
+def decode_points(parsed_features, key, encoding):
+    """Reconstruct the (N, 5) float32 point tensor of key from the parsed features"""
+    shape = parsed_features['lidar/shape/' + key]
+    if encoding == 'float_list':
+        points = tf.sparse.to_dense(parsed_features['lidar/' + key])
+    else:
+        points = tf.io.decode_raw(parsed_features['lidar/' + key], TF_DTYPES[encoding], little_endian=True)
+        points = tf.cast(points, tf.float32)
+        if encoding == 'int16':
+            points = points * parsed_features['lidar/scale/' + key]
+    return tf.reshape(points, shape)
+
+
+def parse_lidar(serialized_example, point_keys, encoding):
+    """Parse a serialized example and return a dict with the decoded point cloud of every point key"""
+    parsed_features = tf.io.parse_single_example(serialized_example, lidar_feature_description(point_keys, encoding))
+    return {key: decode_points(parsed_features, key, encoding) for key in point_keys}
@@ -1,12 +1,37 @@
 import tensorflow as tf
 import numpy as np
 import logging
+import glob
+import json
+import multiprocessing
+import os
 
 logger = logging.getLogger(name='TfRecordsBuild')
 
 
-class TFCreator(object):
+_conversion_class = None
+
+
+def _init_worker(conversionClass):
+    global _conversion_class
+    _conversion_class = conversionClass
+
 
+def serialize_entry(entry):
+    """Read one entry and return its serialized tf.train.Example"""
+    total_id, entry_id = entry
+    data = _conversion_class.read_data(entry_id, total_id)
+    return entry_id, _conversion_class.create_example(data).SerializeToString()
+
+
+class TFCreator(object):
+    """
+    Writes the entries into sharded TFRecord files. Examples are serialized by a process pool fed with entry ids and
+    written in sorted entry order by the main process. A shard is closed once it reaches shard_bytes or, without a
+    byte target, after batch_size examples. Each shard is written to a temporary file and renamed when complete, and the
+    manifest <stage>_manifest.json maps every finished shard to its entry ids so interrupted runs resume. Without resume
+    the shards of the previous manifest are deleted, leftover temporary shards are deleted in both cases.
+    """
 
     def __init__(self, entry_ids,
                  stage,
@@ -15,104 +40,102 @@ class TFCreator(object):
                  batch_size,
                  num_threads,
                  conversionClass,
-                 force_same_shape):
+                 force_same_shape,
+                 shard_bytes=None,
+                 resume=True):
 
         # retrieve itemized list of entries
         self.force_same_shape = force_same_shape
         self.batch_size = batch_size
+        self.shard_bytes = shard_bytes
         self.stage = stage
         self.source_dir = source_dir
         self.num_threads = num_threads
         self.dataset_dir = dataset_dir
-        self.entry_count = len(entry_ids)
-        if self.num_threads <= 1:
-            self.Parellize = False
-        else:
-            self.Parellize = True
+        self.Parellize = self.num_threads > 1
 
-        self.n_files = len(entry_ids)
         self.conversionClass = conversionClass
-        # sort entry ids
-        aix = sorted(range(len(entry_ids)), key=lambda k: entry_ids[k])
-        entry_ids = [entry_ids[num] for num in aix]
-        # create batches of entry id's
-        self.reshaped_entry_ids = [entry_ids[idx * batch_size:idx * batch_size + batch_size] for idx in
-                                   range(0, int(len(entry_ids) / batch_size))]
-        self.reshaped_entry_ids.append(entry_ids[int(len(entry_ids) / batch_size) * batch_size:-1])
+        # sort and deduplicate entry ids, the position in this list is the total id of an entry
+        self.entry_ids = sorted(set(entry_ids))
+        if len(self.entry_ids) != len(entry_ids):
+            logger.warning('Dropped %d duplicate entries' % (len(entry_ids) - len(self.entry_ids)))
+        self.n_files = len(self.entry_ids)
+        self.entry_count = self.n_files
+
+        self.manifest_path = os.path.join(self.dataset_dir, '%s_manifest.json' % self.stage)
+        self.manifest = {'stage': self.stage, 'shards': {}}
+        # unfinished shards of crashed runs
+        for tmp_file in glob.glob(os.path.join(self.dataset_dir, '%s_*.tmp' % self.stage)):
+            os.remove(tmp_file)
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if resume:
+                # shards which are listed but missing on disk are written again
+                self.manifest = manifest
+                self.manifest['shards'] = {shard: ids for shard, ids in self.manifest['shards'].items()
+                                           if os.path.isfile(os.path.join(self.dataset_dir, shard))}
+            else:
+                # a new run reuses the shard indices, shards of the old run must not remain next to the new ones
+                for shard in manifest['shards']:
+                    if os.path.isfile(os.path.join(self.dataset_dir, shard)):
+                        os.remove(os.path.join(self.dataset_dir, shard))
+                os.remove(self.manifest_path)
+                logger.info('Removed %d shards of the previous run' % len(manifest['shards']))
 
     def __call__(self, *args, **kwargs):
-        label_shape, feature_shape, feature_sum = [None, None, None]
-        if self.Parellize == False:
-            label_shape, feature_shape, feature_sum = self.loop()
-        elif self.Parellize == True:
-            label_shape, feature_shape, feature_sum = self.parallellized_loop()
+        done = set(entry_id for ids in self.manifest['shards'].values() for entry_id in ids)
+        todo = [(total_id, entry_id) for total_id, entry_id in enumerate(self.entry_ids) if entry_id not in done]
+        if done:
+            logger.info('Resuming, %d entries already written to %d shards' % (len(done), len(self.manifest['shards'])))
+
+        if self.Parellize and len(todo) > 0:
+            pool = multiprocessing.Pool(processes=self.num_threads, initializer=_init_worker,
+                                        initargs=(self.conversionClass,))
+            try:
+                self.write_shards(pool.imap(serialize_entry, todo), len(todo))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_worker(self.conversionClass)
+            self.write_shards(map(serialize_entry, todo), len(todo))
 
         logger.info('Found %d entries for stage %s' % (self.n_files, self.stage))
 
-    def process_example(self, data_dict, tfrecord_writer):
-
-
-        tf_train_example = self.conversionClass.create_example(data_dict)
-        tfrecord_writer.write(tf_train_example.SerializeToString())
-
-        return None, None, None
-
-    def loop(self):
-        label_shape, feature_shape, feature_sum = [None, None, None]
-        for tfrecord_file_idx, batch in enumerate(self.reshaped_entry_ids):
-            # print('tfrecord_file_idx, batch', tfrecord_file_idx, batch)
+    def write_shards(self, serialized_examples, n_examples):
+        writer = None
+        shard_ids = []
+        shard_size = 0
+        for processed, (entry_id, example) in enumerate(serialized_examples):
+            if writer is None:
+                writer, tf_filename = self.open_shard()
+            writer.write(example)
+            shard_ids.append(entry_id)
+            shard_size += len(example)
+            if (shard_size >= self.shard_bytes) if self.shard_bytes else (len(shard_ids) >= self.batch_size):
+                self.close_shard(writer, tf_filename, shard_ids)
+                writer, shard_ids, shard_size = None, [], 0
+            logger.info('Processed %d/%d' % (processed + 1, n_examples))
+        if writer is not None:
+            self.close_shard(writer, tf_filename, shard_ids)
+
+    def open_shard(self):
+        # first shard index which is not taken by a finished shard of the manifest
+        idx = len(self.manifest['shards'])
+        while True:
             tf_filename = self.conversionClass.get_output_filename(output_dir=self.dataset_dir,
                                                                    name=self.stage,
-                                                                   idx=tfrecord_file_idx)
-
-            label_shape, feature_shape, feature_sum = self.write_tf_records_file(tf_filename, batch, tfrecord_file_idx)
-
-            logger.info('Processed %d/%d' % (tfrecord_file_idx + 1, len(self.reshaped_entry_ids)))
-
-        return label_shape, feature_shape, feature_sum
-
-    def procedure(self, j):  # just factoring out the
-        tfrecord_file_idx = j
-        batch = self.reshaped_entry_ids[tfrecord_file_idx]
-        tf_filename = self.conversionClass.get_output_filename(output_dir=self.dataset_dir,
-                                                               name=self.stage,
-                                                               idx=tfrecord_file_idx)
-        logger.info('Processed %d/%d' % (tfrecord_file_idx + 1, len(self.reshaped_entry_ids)))
-
-        # call the calculation
-        return self.write_tf_records_file(tf_filename, batch, j)
-
-    def parallellized_loop(self):
-
-        process_map = lambda x: self.procedure(x)
-
-        import pathos.pools as pp
-        pool = pp.ProcessPool(self.num_threads)
-
-        a = pool.map(process_map, range(len(self.reshaped_entry_ids)))
-
-        label_shape, feature_shape, feature_sum = a[0]
-
-        return label_shape, feature_shape, feature_sum
-
-    def write_tf_records_file(self, tf_filename, batch, j):
-        feature_sum = None
-        label_shape_out = None
-        feature_shape_out = None
-        feature_out = None
-
-        with tf.io.TFRecordWriter(tf_filename) as tfrecord_writer:
-            for idx, entry_id in enumerate(batch):
-                total_id = j + idx
-
-                feature = None
-                data_file_idx = 0
-                feature_shape = None
-                numpy_lidar = None
-                numpy_lidar_shape = None
-
-                data = self.conversionClass.read_data(entry_id, total_id)
-
-                label_shape_out, feature_shape_out, feature_out = self.process_example(data, tfrecord_writer)
-
-        return label_shape_out, feature_shape_out, feature_out
+                                                                   idx=idx)
+            if os.path.basename(tf_filename) not in self.manifest['shards']:
+                break
+            idx += 1
+        return tf.io.TFRecordWriter(tf_filename + '.tmp'), tf_filename
+
+    def close_shard(self, writer, tf_filename, shard_ids):
+        writer.close()
+        os.replace(tf_filename + '.tmp', tf_filename)
+        self.manifest['shards'][os.path.basename(tf_filename)] = list(shard_ids)
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
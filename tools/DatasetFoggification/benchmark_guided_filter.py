@@ -0,0 +1,54 @@
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+
+from image_foggification import guidedfilter3, fast_guidedfilter3, transmittance
+
+
+def parsArgs():
+    parser = argparse.ArgumentParser(description='Compare runtime and accuracy of the guided filter implementations')
+    parser.add_argument('--image', '-i', help='Guidance image', default='./example_data/ImageData/2019-09-11_19-13-44_00960.png')
+    parser.add_argument('--beta', '-b', type=float, help='Fog density used for the synthetic transmittance', default=0.16)
+    parser.add_argument('--subsample', '-s', type=int, nargs='+', help='Subsampling factors of the fast guided filter', default=[1, 2, 4])
+    parser.add_argument('--repeat', '-n', type=int, help='Number of timed runs per implementation', default=3)
+    return parser.parse_args()
+
+
+def synthetic_transmittance(shape, beta):
+    """Transmittance of a depth ramp from 5m at the bottom to 150m at the top, filtered as in fogify"""
+    depth = np.repeat(np.linspace(150, 5, shape[0], dtype=np.float32)[:, np.newaxis], shape[1], axis=1)
+    transmittance_ = np.clip((transmittance(depth, beta) * 255), 0, 255).astype(np.uint8)
+    transmittance_ = cv2.bilateralFilter(transmittance_, 9, 75, 75)
+    return transmittance_.astype(np.float32) / 255
+
+
+def timeit(function, repeat):
+    result = function()
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    return result, (time.time() - start) / repeat
+
+
+def main(args):
+    image = cv2.imread(args.image)
+    if image is None:
+        raise IOError('Could not read %s' % args.image)
+    I = image.astype(np.float32) / 255
+    p = synthetic_transmittance(image.shape[:2], args.beta)
+    print('%s %dx%d' % (os.path.basename(args.image), image.shape[1], image.shape[0]))
+
+    reference, reference_time = timeit(lambda: guidedfilter3(I, p, 20, 1e-3), args.repeat)
+    print('%-12s %8.1f ms' % ('reference', reference_time * 1000))
+    for s in args.subsample:
+        q, fast_time = timeit(lambda: fast_guidedfilter3(I, p, 20, 1e-3, s=s), args.repeat)
+        print('%-12s %8.1f ms  speedup %5.1fx  max abs error %.2e' % (
+            'fast s=%d' % s, fast_time * 1000, reference_time / fast_time, np.max(np.abs(q - reference))))
+
+
+if __name__ == '__main__':
+    args = parsArgs()
+    main(args)
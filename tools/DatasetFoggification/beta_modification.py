@@ -1,5 +1,8 @@
 import numpy as np
 
+# Number of points evaluated at once in BetaRadomization._evaluate
+CHUNK_SIZE = 65536
+
 
 class BetaRadomization():
 
@@ -31,6 +34,11 @@ class BetaRadomization():
         self.intensitya = np.random.uniform(0, 0.1/self.number_angle/2, size=self.number_angle)
         self.intensityh = np.random.uniform(0, 0.1/self.number_angle/2, size=self.number_angle)
 
+        # optional precomputed (angle, height) grid, see precompute_lookup
+        self.lookup_basis = None
+        self.lookup_grid = None
+        self.lookup_offsets = None
+
         pass
 
     def propagate_in_time(self, timestep):
@@ -58,13 +66,100 @@ class BetaRadomization():
             a = angle_h
             h = height
 
-        output = np.zeros(np.shape(a))
-        for fa, fh, oa, oh, Ah, Aa in zip(self.frequencies_angle, self.frequencies_height, self.offseta, self.offseth, self.intensityh, self.intensitya):
-            output += np.abs((Aa*np.sin(fa*a+oa)/fa+Ah*np.sin(fa*a+fh*h+oh)))
+        return self._evaluate(a, h) + np.float32(self.beta)
 
-        output += self.beta
-        print(output)
-        return output
+    def _evaluate(self, angle_h, height, chunk_size=CHUNK_SIZE):
+        """
+        Evaluates all fourier components at once in float32. Points are processed in chunks so that the
+        (points x components) intermediate stays memory bounded.
+        """
+        angle_h = np.asarray(angle_h, dtype=np.float32)
+        height = np.broadcast_to(np.asarray(height, dtype=np.float32), angle_h.shape)
+        shape = angle_h.shape
+        angle_h = angle_h.reshape(-1, 1)
+        height = height.reshape(-1, 1)
+
+        fa = self.frequencies_angle.astype(np.float32)
+        fh = self.frequencies_height.astype(np.float32)
+        oa = self.offseta.astype(np.float32)
+        oh = self.offseth.astype(np.float32)
+        Aa = (self.intensitya / self.frequencies_angle).astype(np.float32)
+        Ah = self.intensityh.astype(np.float32)
+
+        output = np.empty(angle_h.shape[0], dtype=np.float32)
+        for start in range(0, angle_h.shape[0], chunk_size):
+            phase = angle_h[start:start + chunk_size] * fa
+            component = np.sin(phase + oa)
+            component *= Aa
+            phase += height[start:start + chunk_size] * fh
+            phase += oh
+            np.sin(phase, out=phase)
+            phase *= Ah
+            component += phase
+            np.abs(component, out=component)
+            component.sum(axis=1, out=output[start:start + chunk_size])
+
+        return output.reshape(shape)
+
+    def precompute_lookup(self, angle_bins=256, height_bins=256):
+        """
+        Precomputes the sine and cosine of every fourier component on a (angle, height) grid over one period.
+        All frequencies are integers, therefore the function is 2*pi periodic in both angle and height.
+        The beta grid is recombined from this basis whenever the offsets changed through propagate_in_time,
+        so the basis can be reused for all frames of a sequence.
+        """
+        angle = np.arange(angle_bins, dtype=np.float32) * np.float32(2 * np.pi / angle_bins)
+        height = np.arange(height_bins, dtype=np.float32) * np.float32(2 * np.pi / height_bins)
+        fa = self.frequencies_angle.astype(np.float32)
+        fh = self.frequencies_height.astype(np.float32)
+
+        phase_angle = angle[:, np.newaxis, np.newaxis] * fa
+        phase_height = phase_angle + height[np.newaxis, :, np.newaxis] * fh
+        self.lookup_basis = (np.sin(phase_angle), np.cos(phase_angle), np.sin(phase_height), np.cos(phase_height))
+        self.lookup_grid = None
+        self.lookup_offsets = None
+
+    def _lookup(self):
+        """Returns the beta grid for the current offsets, recombining it from the basis only if they changed"""
+        offsets = np.concatenate((self.offseta, self.offseth))
+        if self.lookup_grid is None or not np.array_equal(offsets, self.lookup_offsets):
+            sin_a, cos_a, sin_h, cos_h = self.lookup_basis
+            Aa = (self.intensitya / self.frequencies_angle).astype(np.float32)
+            Ah = self.intensityh.astype(np.float32)
+            # sin(x + o) = sin(x) cos(o) + cos(x) sin(o)
+            component = sin_h * (Ah * np.cos(self.offseth)).astype(np.float32)
+            component += cos_h * (Ah * np.sin(self.offseth)).astype(np.float32)
+            component += sin_a * (Aa * np.cos(self.offseta)).astype(np.float32)
+            component += cos_a * (Aa * np.sin(self.offseta)).astype(np.float32)
+            np.abs(component, out=component)
+            self.lookup_grid = component.sum(axis=2) + np.float32(self.beta)
+            self.lookup_offsets = offsets
+        return self.lookup_grid
+
+    def _interpolate_lookup(self, angle_h, height):
+        """Bilinear interpolation in the periodic beta grid"""
+        grid = self._lookup()
+        angle_bins, height_bins = grid.shape
+        u = np.asarray(angle_h, dtype=np.float32) * np.float32(angle_bins / (2 * np.pi))
+        v = np.asarray(height, dtype=np.float32) * np.float32(height_bins / (2 * np.pi))
+        u0 = np.floor(u)
+        v0 = np.floor(v)
+        fu = u - u0
+        fv = v - v0
+        u0 = u0.astype(np.int64) % angle_bins
+        v0 = v0.astype(np.int64) % height_bins
+        u1 = (u0 + 1) % angle_bins
+        v1 = (v0 + 1) % height_bins
+        u0 *= height_bins
+        u1 *= height_bins
+
+        flat_grid = grid.ravel()
+        top = np.take(flat_grid, u0 + v0)
+        top += (np.take(flat_grid, u0 + v1) - top) * fv
+        bottom = np.take(flat_grid, u1 + v0)
+        bottom += (np.take(flat_grid, u1 + v1) - bottom) * fv
+        top += (bottom - top) * fu
+        return top
 
     def _print_function(self):
         """
@@ -79,7 +174,10 @@ class BetaRadomization():
     def get_beta(self, distance_forward, right, height):
         distance_forward = np.where(distance_forward == 0, np.ones_like(distance_forward) * 0.0001, distance_forward)
         angle = np.tan(np.divide(right, distance_forward))
-        beta_usefull = self._function(angle, height)
+        if self.lookup_basis is not None:
+            beta_usefull = self._interpolate_lookup(angle, height)
+        else:
+            beta_usefull = self._function(angle, height)
 
         return beta_usefull
 
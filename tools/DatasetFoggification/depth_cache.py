@@ -0,0 +1,84 @@
+"""
+Cache for dense depth and disparity maps. The .mat (depth_map) and .npz (arr_0) files are decoded once and stored
+as .npy files next to the source (x.mat -> x.mat.npy), which can be memory-mapped and are used automatically by
+load_dense_map.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+SOURCE_KEYS = {'.mat': 'depth_map', '.npz': 'arr_0'}
+CACHE_DTYPES = ['float32', 'float16']
+
+
+def parsArgs():
+    parser = argparse.ArgumentParser(description='Convert dense depth maps to memory-mappable .npy files')
+    parser.add_argument('--root', '-r', help='Enter the root folder', default='./example_data/')
+    parser.add_argument('--depth_folder', '-d', help='Data folder precise Depth', default='DepthData')
+    parser.add_argument('--dtype', choices=CACHE_DTYPES, help='Storage type of the cached maps', default='float32')
+    parser.add_argument('--overwrite', action='store_true', help='Recreate existing caches')
+    return parser.parse_args()
+
+
+def cache_path(path):
+    # keeps the source extension, x.mat and x.npz in one folder must not share a cache
+    return path + '.npy'
+
+
+def read_dense_map(path, key=None):
+    """Decode a dense map from a .mat or .npz file"""
+    extension = os.path.splitext(path)[1]
+    key = key or SOURCE_KEYS[extension]
+    if extension == '.mat':
+        import scipy.io
+        return scipy.io.loadmat(path)[key]
+    with np.load(path) as data:
+        return data[key]
+
+
+def is_cached(path):
+    """A cache is valid if it exists and is not older than its source"""
+    cache = cache_path(path)
+    return os.path.isfile(cache) and (not os.path.isfile(path) or os.path.getmtime(cache) >= os.path.getmtime(path))
+
+
+def write_dense_map_cache(path, dtype='float32', key=None):
+    dense_map = read_dense_map(path, key).astype(dtype)
+    cache = cache_path(path)
+    # np.save appends .npy to names without it
+    tmp = cache + '.tmp.npy'
+    np.save(tmp, dense_map)
+    os.replace(tmp, cache)
+    return dense_map
+
+
+def load_dense_map(path, key=None, mmap=True):
+    """
+    Load a dense map from its .npy cache if present, otherwise decode the source file.
+    The cached map is returned read-only memory-mapped with mmap=True and in its stored dtype (float16 or float32).
+    """
+    if is_cached(path):
+        return np.load(cache_path(path), mmap_mode='r' if mmap else None)
+    return read_dense_map(path, key)
+
+
+def main(args):
+    folder = os.path.join(args.root, args.depth_folder)
+    files = sorted(f for f in os.listdir(folder) if os.path.splitext(f)[1] in SOURCE_KEYS)
+    start = time.time()
+    converted = 0
+    for idx, file_name in enumerate(files):
+        path = os.path.join(folder, file_name)
+        if not args.overwrite and is_cached(path):
+            continue
+        write_dense_map_cache(path, args.dtype)
+        converted += 1
+        print('%d/%d %s' % (idx + 1, len(files), cache_path(path)))
+    print('converted %d of %d maps in %.2fs' % (converted, len(files), time.time() - start))
+
+
+if __name__ == '__main__':
+    args = parsArgs()
+    main(args)
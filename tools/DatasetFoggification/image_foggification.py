@@ -6,11 +6,12 @@ import scipy.ndimage
 import numpy as np
 import cv2
 import sys
-import gc
 import time
+from collections import deque
 import argparse
 
 import multiprocessing
+from depth_cache import load_dense_map
 WORKERS = multiprocessing.cpu_count()-1 or 1
 
 
@@ -20,9 +21,18 @@ def parsArgs():
     parser.add_argument('--depth_folder', '-d', help='Data folder precise Depth', default='DepthData')
     parser.add_argument('--image_folder', '-i', help='Data folder Images', default='ImageData')
     parser.add_argument('--beta', '-b', type=float, help='Enter the fog density beta', default=0.16)
-    parser.add_argument('--parallel', '-p', type=bool, help='Parallel execution', default=False)
+    parser.add_argument('--betas', type=float, nargs='+', help='Fog densities rendered in one pass, overrides --beta', default=None)
+    parser.add_argument('--parallel', '-p', action='store_true', help='Parallel execution')
+    parser.add_argument('--workers', '-w', type=int, help='Number of worker processes for --parallel', default=WORKERS)
+    parser.add_argument('--prefetch', type=int, help='Maximum number of images in flight per worker', default=2)
+    parser.add_argument('--overwrite', action='store_true', help='Recompute outputs that already exist instead of skipping them')
+    parser.add_argument('--guided_filter', '-g', choices=GUIDED_FILTERS, help='Guided filter implementation for the transmittance', default='fast')
+    parser.add_argument('--atmospheric_light', '-a', choices=['fast', 'reference'], help='Atmospheric light estimator', default='fast')
+    parser.add_argument('--cache_atmospheric_light', action='store_true', help='Estimate the atmospheric light once per recording')
+    parser.add_argument('--subsample', type=int, help='Subsampling factor of the fast guided filter, 1 disables subsampling', default=1)
     args = parser.parse_args()
-    args.destination_folder = 'hazing/image_beta%.5f'%args.beta
+    args.betas = args.betas or [args.beta]
+    args.destination_folders = ['hazing/image_beta%.5f'%beta for beta in args.betas]
     global hazed
 
     return args
@@ -81,6 +91,83 @@ def guidedfilter3(I, p, r, eps):
     return q
 
 
+class FastGuidedFilter(object):
+    """
+    Color guided filter in float32 with the same window as guidedfilter3.
+    Everything that only depends on the guidance image I (means, closed form inverse of the 3x3 covariance via its
+    adjugate) is computed once in the constructor, so filter() can be applied to many inputs p.
+    All box sums of one step are computed in one stacked boxFilter call (cv2.boxFilter is normalized, so no division by N).
+    With s > 1 the coefficients are computed on images subsampled by s and upsampled bilinearly (fast guided filter).
+    """
+
+    def __init__(self, I, r, eps, s=1):
+        I = np.asarray(I, dtype=np.float32)
+        self.shape = I.shape[:2]
+        self.s = s
+        # planar channels keep all per pixel arithmetic on contiguous arrays
+        self.I_full = cv2.split(I)
+        if s > 1:
+            self.size = (max(I.shape[1] // s, 1), max(I.shape[0] // s, 1))
+            I = cv2.resize(I, self.size, interpolation=cv2.INTER_AREA)
+            r = max(int(round(r / s)), 1)
+        self.r = r
+
+        I_r, I_g, I_b = self.I = cv2.split(I)
+        means = cv2.split(boxfilter(cv2.merge([I_r, I_g, I_b, I_r * I_r, I_r * I_g, I_r * I_b,
+                                               I_g * I_g, I_g * I_b, I_b * I_b]), r))
+        mean_I_r, mean_I_g, mean_I_b = self.mean_I = means[0:3]
+        eps = np.float32(eps)
+        var_I_rr = means[3] - mean_I_r * mean_I_r + eps
+        var_I_rg = means[4] - mean_I_r * mean_I_g
+        var_I_rb = means[5] - mean_I_r * mean_I_b
+        var_I_gg = means[6] - mean_I_g * mean_I_g + eps
+        var_I_gb = means[7] - mean_I_g * mean_I_b
+        var_I_bb = means[8] - mean_I_b * mean_I_b + eps
+
+        # closed form inverse of the symmetric covariance matrix via its adjugate
+        inv_rr = var_I_gg * var_I_bb - var_I_gb * var_I_gb
+        inv_rg = var_I_rb * var_I_gb - var_I_rg * var_I_bb
+        inv_rb = var_I_rg * var_I_gb - var_I_rb * var_I_gg
+        inv_gg = var_I_rr * var_I_bb - var_I_rb * var_I_rb
+        inv_gb = var_I_rg * var_I_rb - var_I_rr * var_I_gb
+        inv_bb = var_I_rr * var_I_gg - var_I_rg * var_I_rg
+        det = var_I_rr * inv_rr + var_I_rg * inv_rg + var_I_rb * inv_rb
+        self.Sigma_inv = [inv / det for inv in (inv_rr, inv_rg, inv_rb, inv_gg, inv_gb, inv_bb)]
+
+    def filter(self, p):
+        p = np.asarray(p, dtype=np.float32)
+        if self.s > 1:
+            p = cv2.resize(p, self.size, interpolation=cv2.INTER_AREA)
+        I_r, I_g, I_b = self.I
+        mean_I_r, mean_I_g, mean_I_b = self.mean_I
+        inv_rr, inv_rg, inv_rb, inv_gg, inv_gb, inv_bb = self.Sigma_inv
+
+        mean_p, mean_Ip_r, mean_Ip_g, mean_Ip_b = cv2.split(boxfilter(cv2.merge([p, I_r * p, I_g * p, I_b * p]), self.r))
+        cov_Ip_r = mean_Ip_r - mean_I_r * mean_p
+        cov_Ip_g = mean_Ip_g - mean_I_g * mean_p
+        cov_Ip_b = mean_Ip_b - mean_I_b * mean_p
+
+        a_r = cov_Ip_r * inv_rr + cov_Ip_g * inv_rg + cov_Ip_b * inv_rb
+        a_g = cov_Ip_r * inv_rg + cov_Ip_g * inv_gg + cov_Ip_b * inv_gb
+        a_b = cov_Ip_r * inv_rb + cov_Ip_g * inv_gb + cov_Ip_b * inv_bb
+        b = mean_p - a_r * mean_I_r - a_g * mean_I_g - a_b * mean_I_b
+
+        mean_coefficients = boxfilter(cv2.merge([a_r, a_g, a_b, b]), self.r)
+        if self.s > 1:
+            mean_coefficients = cv2.resize(mean_coefficients, (self.shape[1], self.shape[0]), interpolation=cv2.INTER_LINEAR)
+        mean_a_r, mean_a_g, mean_a_b, mean_b = cv2.split(mean_coefficients)
+        I_r, I_g, I_b = self.I_full
+        return mean_a_r * I_r + mean_a_g * I_g + mean_a_b * I_b + mean_b
+
+
+def fast_guidedfilter3(I, p, r, eps, s=1):
+    """Single use FastGuidedFilter, drop-in replacement for guidedfilter3"""
+    return FastGuidedFilter(I, r, eps, s=s).filter(p)
+
+
+GUIDED_FILTERS = ['fast', 'reference']
+
+
 def transmittance(depth, beta):
     return np.e**(-beta * depth.astype(np.float32))
 
@@ -102,7 +189,6 @@ def topk(array_1d, k):
     return array_1d[np.argpartition(array_1d, -k)[-k:]]
 
 def dark_channel(image, kernel_size):
-    print(image.shape)
     image= np.min(image,2)
     
     dc= scipy.ndimage.minimum_filter(image, kernel_size)
@@ -128,66 +214,179 @@ def atmospheric_light(image):
     return np.max(np.max(image[dark_filter],1),0)
 
 
-def fogify(image, depth, beta, atmospheric_light_):
+def fast_atmospheric_light(image, kernel_size=10, rank=105, downsample=1):
+    """
+    Faster variant of atmospheric_light. The dark channel is computed with cv2.erode, optionally on an image
+    downsampled by downsample. As in atmospheric_light, every column is thresholded at the median of its top 2*rank
+    dark pixels, found with np.partition (rank is scaled to the downsampled height). A column only contributes if the
+    median is a pixel value, i.e. its rank-th and rank+1-th brightest dark pixels are equal. Returns the brightest
+    channel value among the pixels at their column's threshold.
+    """
+    height = image.shape[0]
+    if downsample > 1:
+        image = cv2.resize(image, (max(image.shape[1] // downsample, 1), max(image.shape[0] // downsample, 1)),
+                           interpolation=cv2.INTER_AREA)
+        kernel_size = max(int(round(kernel_size / downsample)), 1)
+    blue, green, red = cv2.split(image)
+    dark = cv2.erode(cv2.min(cv2.min(blue, green), red), np.ones((kernel_size, kernel_size), np.uint8),
+                     borderType=cv2.BORDER_REFLECT)
+    rows = dark.shape[0]
+    k = min(max(int(round(rank * rows / float(height))), 1), rows - 1)
+    top = np.partition(dark, (rows - k - 1, rows - k), axis=0)
+    threshold = top[rows - k]
+    mask = (dark == threshold) & (top[rows - k - 1] == threshold)
+    if not mask.any():
+        # no column median is a pixel value, fall back to the rank-th brightest dark pixel of every column
+        mask = dark == threshold
+    return max(blue[mask].max(), green[mask].max(), red[mask].max())
+
+
+ATMOSPHERIC_LIGHT_ESTIMATORS = {'fast': fast_atmospheric_light, 'reference': atmospheric_light}
+
+
+def fogify(image, depth, beta, atmospheric_light_, guided_filter='fast', subsample=1):
+    return fogify_betas(image, depth, [beta], atmospheric_light_, guided_filter=guided_filter, subsample=subsample)[0]
+
+
+def fogify_betas(image, depth, betas, atmospheric_light_, guided_filter='fast', subsample=1):
+    """
+    Fogify one image for several fog densities. The valid pixel mask and the guidance statistics of the guided
+    filter do not depend on beta and are computed only once.
+    """
     get_rect_left = np.where((np.not_equal(image[:, :, 0], 0) & np.not_equal(image[:, :, 1], 0) & np.not_equal(image[:, :, 2], 0)))
-    fog_image = image.copy()
-    transmittance_ = transmittance(depth, beta)
-    transmittance_ = np.clip((transmittance_ * 255), 0, 255).astype(np.uint8)
-    transmittance_ = cv2.bilateralFilter(transmittance_, 9, 75, 75)
-    transmittance_ = transmittance_.astype(np.float32) / 255
-    transmittance_ = np.clip(transmittance_, 0, 1)
     image = np.clip(image, 0,255)
-    transmittance_ = guidedfilter3(image.astype(np.float32)/255, transmittance_, 20, 1e-3)
-    transmittance_ = transmittance_[:, :, np.newaxis]
-    fog_image[get_rect_left] = np.clip(image[get_rect_left] * transmittance_[get_rect_left] + atmospheric_light_ *
-                        (1 - transmittance_[get_rect_left]), 0, 255).astype(np.uint8)
-    return fog_image
-
-name = 'image_lab_all'
-cv2.namedWindow(name,cv2.WINDOW_NORMAL)
+    guidance = image.astype(np.float32)/255
+    if guided_filter != 'reference':
+        fast_filter = FastGuidedFilter(guidance, 20, 1e-3, s=subsample)
+    depth = depth.astype(np.float32)
+    image_rect_left = image[get_rect_left]
+
+    fog_images = []
+    for beta in betas:
+        transmittance_ = transmittance(depth, beta)
+        transmittance_ = np.clip((transmittance_ * 255), 0, 255).astype(np.uint8)
+        transmittance_ = cv2.bilateralFilter(transmittance_, 9, 75, 75)
+        transmittance_ = transmittance_.astype(np.float32) / 255
+        transmittance_ = np.clip(transmittance_, 0, 1)
+        if guided_filter == 'reference':
+            transmittance_ = guidedfilter3(guidance, transmittance_, 20, 1e-3)
+        else:
+            transmittance_ = fast_filter.filter(transmittance_)
+        transmittance_ = transmittance_[:, :, np.newaxis]
+        fog_image = image.copy()
+        fog_image[get_rect_left] = np.clip(image_rect_left * transmittance_[get_rect_left] + atmospheric_light_ *
+                            (1 - transmittance_[get_rect_left]), 0, 255).astype(np.uint8)
+        fog_images.append(fog_image)
+    return fog_images
+
 def load_image(image_path):
     return cv2.imread(image_path)
 
+
+def write_image(image_path, image):
+    """Write through a temporary file, so interrupted runs never leave a truncated image that resume would skip"""
+    success, buffer = cv2.imencode(os.path.splitext(image_path)[1], image)
+    if not success:
+        raise IOError('Could not encode %s' % image_path)
+    with open(image_path + '.tmp', 'wb') as f:
+        f.write(buffer.tobytes())
+    os.replace(image_path + '.tmp', image_path)
+
 class Foggify:
 
     def __init__(self,args):
         self.args = args
+        # atmospheric light per recording, illumination is nearly constant within a sequence
+        self.atmospheric_light_cache = {}
+
+    def get_atmospheric_light(self, image, file_name):
+        estimator = ATMOSPHERIC_LIGHT_ESTIMATORS[self.args.atmospheric_light]
+        if not self.args.cache_atmospheric_light:
+            return estimator(image)
+        recording = os.path.splitext(file_name)[0].rsplit('_', 1)[0]
+        if recording not in self.atmospheric_light_cache:
+            self.atmospheric_light_cache[recording] = estimator(image)
+        return self.atmospheric_light_cache[recording]
 
     def fogify_path_tuple(self, image_file):
+        """Fogify one image for all betas, returns the number of written outputs. Existing outputs are skipped."""
+        file_name = os.path.basename(image_file)
+        betas, output_files = [], []
+        for beta, destination_folder in zip(self.args.betas, self.args.destination_folders):
+            output_file = os.path.join(self.args.root, destination_folder, file_name)
+            if self.args.overwrite or not os.path.isfile(output_file):
+                betas.append(beta)
+                output_files.append(output_file)
+        if not betas:
+            return 0
+
         image_path, depth_path = os.path.join(self.args.root,self.args.image_folder,image_file), \
                                  os.path.join(self.args.root,self.args.depth_folder,image_file.replace('.png','.mat'))
 
-        image, depth = load_image(image_path), scipy.io.loadmat(depth_path)["depth_map"]
-        file_name = image_path.split('/')[-1]
-        atmospheric_light_ = atmospheric_light(image)
-        fog_image = image
-        output_file = os.path.join(self.args.root, self.args.destination_folder)
-        if not os.path.isdir(output_file):
-            os.makedirs(output_file)
-        output_file = os.path.join(output_file, file_name)
-        print(output_file)
-        fog_image = fogify(fog_image, depth, self.args.beta, atmospheric_light_)
-
-        cv2.imwrite(output_file, fog_image)
-        gc.collect()
+        image, depth = load_image(image_path), load_dense_map(depth_path, key="depth_map")
+        atmospheric_light_ = self.get_atmospheric_light(image, file_name)
+        fog_images = fogify_betas(image, depth, betas, atmospheric_light_,
+                                  guided_filter=self.args.guided_filter, subsample=self.args.subsample)
+
+        for output_file, fog_image in zip(output_files, fog_images):
+            write_image(output_file, fog_image)
+        return len(output_files)
+
+
+_fog_class = None
+
+
+def _init_worker(args):
+    global _fog_class
+    _fog_class = Foggify(args)
+
+
+def fogify_file(image_file):
+    return _fog_class.fogify_path_tuple(image_file)
     
 
 
 
 def main():
     args = parsArgs()
-    images = os.listdir(os.path.join(args.root,args.image_folder))
+    images = sorted(os.listdir(os.path.join(args.root,args.image_folder)))
+    for destination_folder in args.destination_folders:
+        output_folder = os.path.join(args.root, destination_folder)
+        if not os.path.isdir(output_folder):
+            os.makedirs(output_folder)
+
+    start = time.time()
+    n_written = 0
+
+    def report(idx, image_file, written):
+        elapsed_time = time.time() - start
+        status = '%d outputs' % written if written else 'skipped'
+        print('%d/%d %s (%s), %.2f images/s' % (idx + 1, len(images), image_file, status, (idx + 1) / elapsed_time))
 
-    fogClass = Foggify(args)
     if args.parallel:
-        print("parallel execution with {} workers".format(WORKERS))
-        pool= multiprocessing.Pool(processes=WORKERS)
-        pool.map(fogClass.fogify_path_tuple, images)
+        workers = max(args.workers, 1)
+        print("parallel execution with {} workers".format(workers))
+        pool = multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(args,))
+        # bounded window of submitted images, results are collected and reported in order
+        window = workers * max(args.prefetch, 1)
+        in_flight = deque()
+        for idx, image_file in enumerate(images):
+            in_flight.append((idx, image_file, pool.apply_async(fogify_file, (image_file,))))
+            while in_flight and (len(in_flight) >= window or idx == len(images) - 1):
+                done_idx, done_file, result = in_flight.popleft()
+                written = result.get()
+                n_written += written
+                report(done_idx, done_file, written)
         pool.close()
         pool.join()
     else:
-        for each in images:
-            fogClass.fogify_path_tuple(each)
+        fogClass = Foggify(args)
+        for idx, image_file in enumerate(images):
+            written = fogClass.fogify_path_tuple(image_file)
+            n_written += written
+            report(idx, image_file, written)
+
+    print('elapsed_time %.2fs, wrote %d images for %d betas' % (time.time() - start, n_written, len(args.betas)))
 
 
 if __name__ == "__main__":
@@ -1,20 +1,21 @@
 import argparse
+import json
+import multiprocessing
 import os
 import time
+import zlib
 
 import numpy as np
-import pyqtgraph.opengl as gl
 from beta_modification import BetaRadomization
-from pyqtgraph.Qt import QtGui
+from tools.DatasetViewer.lib.read import load_velodyne_scan, load_velodyne_scans
 
 
 
 #fog density
 
 def load_velo_scan(file):
-    """Load and parse a velodyne binary file. According to Kitti Dataset"""
-    scan = np.fromfile(file, dtype=np.float32)
-    return scan.reshape((-1, 5))[:,0:4]
+    """Load and parse a velodyne binary file. According to Kitti Dataset. Only the first 4 columns are used."""
+    return load_velodyne_scan(file)
 
 
 def parsArgs():
@@ -24,6 +25,19 @@ def parsArgs():
     parser.add_argument('--beta', '-b', type=float, help='Enter the fogdensity beta here', default=0.05)
     parser.add_argument('--fraction_random', type=float, default=0.05, help ='Enter fraction of random scattered points')
     parser.add_argument('--sensor_type', type=str, default='VelodyneHDLS3D', help='chose sensor type either "VelodyneHDLS3D" or VelodyneHDLS2')
+    parser.add_argument('--batch', action='store_true', help='Run the batch engine producing all betas from one scan read')
+    parser.add_argument('--betas', type=float, nargs='+', default=None, help='Enter multiple fog densities for the batch mode')
+    parser.add_argument('--split', '-s', default=None, help='Enter a split file (e.g. ../../splits/all.txt) to select frames')
+    parser.add_argument('--workers', '-w', type=int, default=multiprocessing.cpu_count() - 1 or 1, help='Number of worker processes')
+    parser.add_argument('--seed', type=int, default=0, help='Base seed for the deterministic per frame seeding')
+    parser.add_argument('--sequence', action='store_true', help='Use one temporally coherent fog field per recording')
+    parser.add_argument('--timestamps', default='../DatasetViewer/timestamps.json', help='Enter the timestamps file for the sequence mode')
+    parser.add_argument('--frame_rate', type=float, default=10.0, help='Frame rate of the frame counter in the sample names')
+    parser.add_argument('--timesteps_per_second', type=float, default=50.0, help='Fog field propagation timesteps per second')
+    parser.add_argument('--lookup_bins', type=int, default=256, help='Resolution of the beta lookup grid in sequence mode, 0 disables it')
+    parser.add_argument('--no-viz', dest='no_viz', action='store_true', help='Headless mode, stream scans from disk to disk without the OpenGL viewer')
+    parser.add_argument('--preview_every', type=int, default=0, help='Write a birds eye view PNG every N frames, 0 disables previews')
+    parser.add_argument('--preview_folder', default='hazing/preview', help='Preview folder relative to the root folder')
 
     args = parser.parse_args()
     args.destination_folder = 'velodyne_points_beta%.5f'%args.beta
@@ -32,89 +46,98 @@ def parsArgs():
     return args
 
 
-def haze_point_cloud(pts_3D, Radomized_beta, args):
-    #print 'minmax_values', max(pts_3D[:, 0]), max(pts_3D[:, 1]), min(pts_3D[:, 1]), max(pts_3D[:, 2]), min(pts_3D[:, 2])
-    n = []
+# Lidar parameters per sensor type: n, g and dmin (minimal detectable distance)
+SENSOR_PARAMETERS = {
+    'VelodyneHDLS3D': (0.04, 0.45, 2),  # Velodyne HDLS643D
+    'VelodyneHDLS2': (0.05, 0.35, 2),  # Velodyne HDL64S2
+}
+
+
+def _output_buffer(out, length):
+    """Returns a (length, 5) float32 view into out, allocating a new buffer if out is missing or too small"""
+    if out is None or out.shape[0] < length:
+        return np.empty((length, 5), dtype=np.float32)
+    return out[:length]
+
+
+def haze_point_cloud(pts_3D, Radomized_beta, args, out=None):
+    """
+    Single pass fog simulation. Stable points, cloud scattered points and random scattered points are written
+    in this order straight into one float32 buffer with columns x, y, z, intensity, label (0, 1, 2).
+    :param out: optional (N, 5) float32 buffer which is reused if large enough. The returned array is a view into it.
+    """
     # foggyfication should be applied to sequences to ensure time correlation inbetween frames
-    # vectorze calculation
-    # print pts_3D.shape
-    if args.sensor_type=='VelodyneHDLS3D':
-        # Velodyne HDLS643D
-        n = 0.04
-        g = 0.45
-        dmin = 2 # Minimal detectable distance
-    elif args.sensor_type=='VelodyneHDLS2':
-        #Velodyne HDL64S2
-        n = 0.05
-        g = 0.35
-        dmin = 2
-    d = np.sqrt(pts_3D[:,0] * pts_3D[:,0] + pts_3D[:,1] * pts_3D[:,1] + pts_3D[:,2] * pts_3D[:,2])
-    detectable_points = np.where(d>dmin)
+    n, g, dmin = SENSOR_PARAMETERS[args.sensor_type]
+
+    xyz = pts_3D[:, 0:3]
+    d = np.sqrt(np.einsum('ij,ij->i', xyz, xyz))
+    detectable_points = d > dmin
     d = d[detectable_points]
     pts_3D = pts_3D[detectable_points]
 
-    beta_usefull = Radomized_beta.get_beta(pts_3D[:,0], pts_3D[:, 1], pts_3D[:, 2])
-    dmax = -np.divide(np.log(np.divide(n,(pts_3D[:,3] + g))),(2 * beta_usefull))
-    dnew = -np.log(1 - 0.5) / (beta_usefull)
+    if Radomized_beta.beta == 0.0:
+        dist_pts_3d = _output_buffer(out, pts_3D.shape[0])
+        dist_pts_3d[:, 0:4] = pts_3D[:, 0:4]
+        dist_pts_3d[:, 4] = 0
+        return dist_pts_3d, []
 
-    probability_lost = 1 - np.exp(-beta_usefull*dmax)
-    lost = np.random.uniform(0, 1, size=probability_lost.shape) < probability_lost
+    beta_usefull = Radomized_beta.get_beta(pts_3D[:, 0], pts_3D[:, 1], pts_3D[:, 2])
+    dmax = -np.log(n / (pts_3D[:, 3] + g)) / (2 * beta_usefull)
+    dnew = -np.log(1 - 0.5) / beta_usefull
 
-    if Radomized_beta.beta == 0.0:
-        dist_pts_3d = np.zeros((pts_3D.shape[0], 5))
-        dist_pts_3d[:, 0:4] = pts_3D
-        dist_pts_3d[:, 4] = np.zeros(np.shape(pts_3D[:, 3]))
-        return dist_pts_3d,  []
-
-    cloud_scatter = np.logical_and(dnew < d, np.logical_not(lost))
-    random_scatter = np.logical_and(np.logical_not(cloud_scatter), np.logical_not(lost))
-    idx_stable = np.where(d<dmax)[0]
-    old_points = np.zeros((len(idx_stable), 5))
-    old_points[:,0:4] = pts_3D[idx_stable,:]
-    old_points[:,3] = old_points[:,3]*np.exp(-beta_usefull[idx_stable]*d[idx_stable])
-    old_points[:, 4] = np.zeros(np.shape(old_points[:,3]))
-
-    cloud_scatter_idx = np.where(np.logical_and(dmax<d, cloud_scatter))[0]
-    cloud_scatter = np.zeros((len(cloud_scatter_idx), 5))
-    cloud_scatter[:,0:4] =  pts_3D[cloud_scatter_idx,:]
-    cloud_scatter[:,0:3] = np.transpose(np.multiply(np.transpose(cloud_scatter[:,0:3]), np.transpose(np.divide(dnew[cloud_scatter_idx],d[cloud_scatter_idx]))))
-    cloud_scatter[:,3] = cloud_scatter[:,3]*np.exp(-beta_usefull[cloud_scatter_idx]*dnew[cloud_scatter_idx])
-    cloud_scatter[:, 4] = np.ones(np.shape(cloud_scatter[:, 3]))
+    probability_lost = 1 - np.exp(-beta_usefull * dmax)
+    not_lost = np.random.uniform(0, 1, size=probability_lost.shape) >= probability_lost
 
+    idx_stable = np.flatnonzero(d < dmax)
+    beyond_dnew = dnew < d
+    cloud_scatter_idx = np.flatnonzero(beyond_dnew & not_lost & (dmax < d))
 
     # Subsample random scatter abhaengig vom noise im Lidar
-    random_scatter_idx = np.where(random_scatter)[0]
-    scatter_max = np.min(np.vstack((dmax, d)).transpose(), axis=1)
-    drand = np.random.uniform(high=scatter_max[random_scatter_idx])
+    random_scatter_idx = np.flatnonzero(np.logical_not(beyond_dnew) & not_lost)
+    drand = np.random.uniform(high=np.minimum(dmax[random_scatter_idx], d[random_scatter_idx]))
     # scatter outside min detection range and do some subsampling. Not all points are randomly scattered.
     # Fraction of 0.05 is found empirically.
-    drand_idx = np.where(drand>dmin)
+    drand_idx = drand > dmin
     drand = drand[drand_idx]
     random_scatter_idx = random_scatter_idx[drand_idx]
-    # Subsample random scattered points to 0.05%
-    print(len(random_scatter_idx), args.fraction_random)
-    subsampled_idx = np.random.choice(len(random_scatter_idx), int(args.fraction_random*len(random_scatter_idx)), replace=False)
+    subsampled_idx = np.random.choice(len(random_scatter_idx), int(args.fraction_random * len(random_scatter_idx)), replace=False)
     drand = drand[subsampled_idx]
     random_scatter_idx = random_scatter_idx[subsampled_idx]
 
+    n_stable, n_cloud = len(idx_stable), len(cloud_scatter_idx)
+    dist_pts_3d = _output_buffer(out, n_stable + n_cloud + len(random_scatter_idx))
+    stable = dist_pts_3d[:n_stable]
+    cloud = dist_pts_3d[n_stable:n_stable + n_cloud]
+    random = dist_pts_3d[n_stable + n_cloud:]
 
-    random_scatter = np.zeros((len(random_scatter_idx), 5))
-    random_scatter[:,0:4] = pts_3D[random_scatter_idx,:]
-    random_scatter[:,0:3] = np.transpose(np.multiply(np.transpose(random_scatter[:,0:3]), np.transpose(drand/d[random_scatter_idx])))
-    random_scatter[:,3] = random_scatter[:,3]*np.exp(-beta_usefull[random_scatter_idx]*drand)
-    random_scatter[:, 4] = 2*np.ones(np.shape(random_scatter[:, 3]))
-
+    stable[:, 0:3] = pts_3D[idx_stable, 0:3]
+    stable[:, 3] = pts_3D[idx_stable, 3] * np.exp(-beta_usefull[idx_stable] * d[idx_stable])
+    stable[:, 4] = 0
 
+    scale = dnew[cloud_scatter_idx]
+    cloud[:, 0:3] = pts_3D[cloud_scatter_idx, 0:3] * (scale / d[cloud_scatter_idx])[:, np.newaxis]
+    cloud[:, 3] = pts_3D[cloud_scatter_idx, 3] * np.exp(-beta_usefull[cloud_scatter_idx] * scale)
+    cloud[:, 4] = 1
 
-    dist_pts_3d = np.concatenate((old_points, cloud_scatter,random_scatter), axis=0)
+    random[:, 0:3] = pts_3D[random_scatter_idx, 0:3] * (drand / d[random_scatter_idx])[:, np.newaxis]
+    random[:, 3] = pts_3D[random_scatter_idx, 3] * np.exp(-beta_usefull[random_scatter_idx] * drand)
+    random[:, 4] = 2
 
-    color = []
-    return dist_pts_3d, color
+    return dist_pts_3d, []
 
 
 def initialize_window():
-    w= None
-    return w
+    # pyqtgraph is imported lazily so that headless batch nodes never load Qt / OpenGL
+    import pyqtgraph.opengl as gl
+    from pyqtgraph.Qt import QtGui
+
+    app = QtGui.QApplication([])
+    w = gl.GLViewWidget()
+    w.show()
+    w.setWindowTitle('Velodyne Pointlcloud')
+    #     86.8051380062 273 - 59
+    w.setCameraPosition(pos=[0,0,0], distance=86.8051380062, azimuth=180, elevation=40)
+    return app, w, gl
 
 def add_random_noise(velodyne_scan):
     random_noise = np.random.normal(0.0, 5, np.shape(velodyne_scan))
@@ -133,6 +156,23 @@ def set_color(dist_pts_3d):
     return np.asarray(color)
 
 
+# BGR colors for stable, cloud scattered and random scattered points in the birds eye view preview
+PREVIEW_COLORS = np.array([[255, 255, 0], [0, 0, 255], [0, 255, 255]], dtype=np.uint8)
+
+
+def write_bev_preview(dist_pts_3d, path, bev_range=50.0, resolution=0.1):
+    """Writes a cheap birds eye view PNG of a foggified scan, x points upwards"""
+    import cv2
+
+    size = int(2 * bev_range / resolution)
+    image = np.zeros((size, size, 3), dtype=np.uint8)
+    x, y = dist_pts_3d[:, 0], dist_pts_3d[:, 1]
+    inside = (np.abs(x) < bev_range) & (np.abs(y) < bev_range)
+    rows = np.clip(((bev_range - x[inside]) / resolution).astype(np.int32), 0, size - 1)
+    cols = np.clip(((bev_range - y[inside]) / resolution).astype(np.int32), 0, size - 1)
+    image[rows, cols] = PREVIEW_COLORS[dist_pts_3d[inside, 4].astype(np.int32)]
+    cv2.imwrite(path, image)
+
 
 def main(walk_path, dest_path, beta, args, DEBUG = True):
     #os.path.join(root_in, folder)
@@ -144,14 +184,13 @@ def main(walk_path, dest_path, beta, args, DEBUG = True):
         files_all = sorted(files)
     print(files_all)
     if DEBUG:
-        w = initialize_window()
-
-        app = QtGui.QApplication([])
-        w = gl.GLViewWidget()
-        w.show()
-        w.setWindowTitle('Velodyne Pointlcloud')
-        #     86.8051380062 273 - 59
-        w.setCameraPosition(pos=[0,0,0], distance=86.8051380062, azimuth=180, elevation=40)
+        app, w, gl = initialize_window()
+    preview_folder = None
+    if args.preview_every > 0:
+        preview_folder = os.path.join(args.root, args.preview_folder)
+        if not os.path.exists(preview_folder):
+            os.makedirs(preview_folder)
+    buffer = None
 
     #g = gl.GLGridItem()
     #w.addItem(g)
@@ -165,9 +204,11 @@ def main(walk_path, dest_path, beta, args, DEBUG = True):
         velodyne_scan = load_velo_scan(os.path.join(walk_path, file1))
         velodyne_scan[:,3] = velodyne_scan[:,3]/255
         start = time.time()
-        dist_pts_3d, color = haze_point_cloud(velodyne_scan, B, args)
+        dist_pts_3d, color = haze_point_cloud(velodyne_scan, B, args, out=buffer)
         end = time.time()
         print('elapsed_time', end - start)
+        if dist_pts_3d.base is None:
+            buffer = dist_pts_3d
 
         if DEBUG:
             pass
@@ -188,12 +229,200 @@ def main(walk_path, dest_path, beta, args, DEBUG = True):
         #Update position in time
         B.propagate_in_time(5)
         save_path_velo = os.path.join(dest_path, file1)
-        dist_pts_3d.astype(np.float32).tofile(save_path_velo)
+        dist_pts_3d.tofile(save_path_velo)
+        if preview_folder is not None and i % args.preview_every == 0:
+            write_bev_preview(dist_pts_3d, os.path.join(preview_folder, os.path.splitext(file1)[0] + '.png'))
+
+
+def read_split(split_file):
+    """Read a split file with "<recording>,<frame>" lines and return the sample names"""
+    with open(split_file, 'r') as f:
+        return [line.strip().replace(',', '_') for line in f if line.strip()]
+
+
+def frame_seed(seed, sample, beta):
+    """Deterministic seed per frame and beta, independent of worker scheduling and of the other requested betas"""
+    return zlib.crc32(('%d_%s_%.5f' % (seed, sample, beta)).encode('utf-8'))
+
+
+def beta_destination_folder(root, beta):
+    return os.path.join(root, 'hazing/velodyne_points_beta%.5f' % beta)
+
+
+def group_by_recording(samples):
+    """Groups sample names "<recording>_<frame>" by recording, frames are sorted within each recording"""
+    recordings = {}
+    for sample in samples:
+        recording = sample.rsplit('_', 1)[0]
+        recordings.setdefault(recording, []).append(sample)
+    return [(recording, sorted(frames)) for recording, frames in sorted(recordings.items())]
+
+
+def load_lidar_timestamps(path):
+    """Lidar entries of DatasetViewer/timestamps.json mapping "<recording>_<frame>" to "<frame>_<offset in ns>" """
+    with open(path, 'r') as f:
+        return json.load(f)['lidar']
+
+
+def frame_time(sample, lidar_timestamps, frame_rate):
+    """Time of a lidar frame in seconds since the start of its recording"""
+    frame = int(sample.rsplit('_', 1)[1])
+    offset = lidar_timestamps.get(sample)
+    offset_ns = int(offset.split('_')[1]) if offset is not None else 0
+    return frame / frame_rate + offset_ns * 1e-9
+
+
+_batch_args = None
+_batch_buffer = None
+_lidar_timestamps = None
+
+
+def _init_batch_worker(args):
+    global _batch_args, _lidar_timestamps
+    _batch_args = args
+    if args.sequence:
+        _lidar_timestamps = load_lidar_timestamps(args.timestamps)
+
+
+def haze_and_save(velodyne_scan, B, file_name):
+    """Hazes one scan with the fog field B and writes it to the folder of B.beta, reusing the worker buffer"""
+    global _batch_buffer
+    args = _batch_args
+    dist_pts_3d, _ = haze_point_cloud(velodyne_scan, B, args, out=_batch_buffer)
+    if dist_pts_3d.base is None:
+        # a new buffer was allocated, reuse it for the next frames of this worker
+        _batch_buffer = dist_pts_3d
+    dist_pts_3d.tofile(os.path.join(beta_destination_folder(args.root, B.beta), file_name))
+    if file_name in args.preview_files:
+        preview_path = os.path.join(args.root, args.preview_folder, 'beta%.5f' % B.beta)
+        write_bev_preview(dist_pts_3d, os.path.join(preview_path, os.path.splitext(file_name)[0] + '.png'))
+
+
+def load_scan(file_name):
+    velodyne_scan = load_velo_scan(os.path.join(_batch_args.root, _batch_args.velodyne_folder, file_name))
+    velodyne_scan[:, 3] = velodyne_scan[:, 3] / 255
+    return velodyne_scan
+
+
+def foggify_frame(sample):
+    """
+    Loads one velodyne scan and writes the foggified scan for every requested beta.
+    :return: number of frames and number of points processed
+    """
+    file_name = sample + '.bin'
+    velodyne_scan = load_scan(file_name)
+
+    for beta in _batch_args.betas:
+        np.random.seed(frame_seed(_batch_args.seed, sample, beta))
+        B = BetaRadomization(beta)
+        B.propagate_in_time(10)
+        haze_and_save(velodyne_scan, B, file_name)
+
+    return 1, velodyne_scan.shape[0]
+
+
+def foggify_recording(recording_samples):
+    """
+    Foggifies all frames of one recording with one temporally coherent fog field per beta. The fields are
+    advanced with the time delta between consecutive lidar frames.
+    :return: number of frames and number of points processed
+    """
+    args = _batch_args
+    recording, samples = recording_samples
+    fields = []
+    for beta in args.betas:
+        np.random.seed(frame_seed(args.seed, recording, beta))
+        B = BetaRadomization(beta)
+        B.propagate_in_time(10)
+        if args.lookup_bins > 0:
+            B.precompute_lookup(args.lookup_bins, args.lookup_bins)
+        fields.append(B)
+
+    # all scans of the recording are read into one contiguous arena
+    arena = load_velodyne_scans([os.path.join(args.root, args.velodyne_folder, sample + '.bin') for sample in samples])
+    arena.points[:, 3] /= 255
+
+    previous_time = None
+    for sample in samples:
+        file_name = sample + '.bin'
+        velodyne_scan = arena[sample]
+        current_time = frame_time(sample, _lidar_timestamps, args.frame_rate)
+        for B in fields:
+            if previous_time is not None:
+                B.propagate_in_time((current_time - previous_time) * args.timesteps_per_second)
+            np.random.seed(frame_seed(args.seed, sample, B.beta))
+            haze_and_save(velodyne_scan, B, file_name)
+        previous_time = current_time
+
+    return len(samples), arena.points.shape[0]
+
+
+def batch_main(args):
+    """
+    Batch engine: every scan is loaded once and hazed for all betas. Frames (or whole recordings in sequence
+    mode) are spread across a worker pool. Throughput is reported at the end of the run.
+    """
+    walk_path = os.path.join(args.root, args.velodyne_folder)
+    if args.split is not None:
+        samples = read_split(args.split)
+    else:
+        samples = sorted(os.path.splitext(file_name)[0] for file_name in os.listdir(walk_path))
+
+    args.preview_files = set()
+    if args.preview_every > 0:
+        args.preview_files = set(sample + '.bin' for sample in samples[::args.preview_every])
+    for beta in args.betas:
+        dest_folders = [beta_destination_folder(args.root, beta)]
+        if args.preview_every > 0:
+            dest_folders.append(os.path.join(args.root, args.preview_folder, 'beta%.5f' % beta))
+        for dest_folder in dest_folders:
+            if not os.path.exists(dest_folder):
+                os.makedirs(dest_folder)
+
+    if args.sequence:
+        items = group_by_recording(samples)
+        process = foggify_recording
+        print('sequence foggification of %d frames in %d recordings for betas %s with %d workers' % (
+            len(samples), len(items), args.betas, args.workers))
+    else:
+        items = samples
+        process = foggify_frame
+        print('batch foggification of %d frames for betas %s with %d workers' % (len(samples), args.betas, args.workers))
+
+    start = time.time()
+    total_frames, total_points = 0, 0
+    if args.workers > 1:
+        pool = multiprocessing.Pool(processes=args.workers, initializer=_init_batch_worker, initargs=(args,))
+        chunksize = 1 if args.sequence else max(1, len(items) // (4 * args.workers))
+        results = pool.imap_unordered(process, items, chunksize=chunksize)
+    else:
+        pool = None
+        _init_batch_worker(args)
+        results = map(process, items)
+
+    for idx, (n_frames, n_points) in enumerate(results):
+        total_frames += n_frames
+        total_points += n_points
+        if (idx + 1) % 100 == 0 or args.sequence:
+            print('Processed %d/%d frames' % (total_frames, len(samples)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print('elapsed_time %.2fs, %.2f frames/s, %.0f points/s (%d betas per frame)' % (
+        elapsed, total_frames / elapsed, total_points / elapsed, len(args.betas)))
 
 
 if __name__ == '__main__':
 
     args = parsArgs()
+    if args.batch or args.sequence:
+        if args.betas is None:
+            args.betas = [args.beta]
+        batch_main(args)
+        exit(0)
     args.destination_folder ='hazing/velodyne_points_beta%.5f'%args.beta
     walk_path = os.path.join(args.root, args.velodyne_folder)
     dest_folder = os.path.join(args.root, args.destination_folder)
@@ -202,7 +431,7 @@ if __name__ == '__main__':
     if not os.path.exists(dest_folder):
         os.makedirs(dest_folder)
     print('started')
-    main(walk_path, dest_folder, beta=args.beta, args=args, DEBUG=True)
+    main(walk_path, dest_folder, beta=args.beta, args=args, DEBUG=not args.no_viz)
 
 
 
@@ -7,6 +7,7 @@ from lib_stats.util import load_gt_obj, read_split, create_statitics_object_clas
 def parsArgs():
     parser = argparse.ArgumentParser(description='Build TF Records')
     parser.add_argument('--label_dir', '-r', help='Enter the raw data source folder')
+    parser.add_argument('--label_cache', type=str, help='Cache file of the parsed labels and difficulties, created if missing or outdated', default=None)
     parser.add_argument('--split_dir', '-d', type=str, help='definde destination directory', default='../../splits')
     parser.add_argument('--dataset-id', '-id', type=str, help='defined dataset id')
     parser.add_argument('--file_list', '-f', help='Enter path to split files', default='DepthData')
@@ -20,7 +21,7 @@ def parsArgs():
 
 if __name__ == '__main__':
     args = parsArgs()
-    labels = load_gt_obj(args.label_dir)
+    labels = load_gt_obj(args.label_dir, cache_file=args.label_cache)
     label_files = ['all']
     for label_file in label_files:
         seleced_files = read_split(args.split_dir, label_file + '.txt')
@@ -50,6 +51,7 @@ if __name__ == '__main__':
                     'unsure': {'range': (-2, 2)},
                     'unsure3dBox': {'range': (-2, 2)},
                     'truncated': {'range': (-1, 1)},
+                    'difficulty': {'range': (0, 4)},
                 }
             else:
                 statistics_params = {
@@ -69,6 +71,7 @@ if __name__ == '__main__':
                     'unsure': {'range': (-2, 2)},
                     'unsure3dBox': {'range': (-2, 2)},
                     'truncated': {'range': (-1, 1)},
+                    'difficulty': {'range': (0, 4)},
                 }
             statistics = create_statitics(labels, seleced_files, statistics_params.keys(), allowed_object_classes)
 
@@ -15,6 +15,8 @@ import cv2
 from datetime import datetime
 from utils_DataViewer import convert_timestamp, colorize_pointcloud, get_time_difference
 from lib.read import load_calib_data, read_label
+from lib.archive import open_lidar_archive
+from lib.metadata import METADATA_FIELDS, open_metadata_index, read_sample_metadata
 from lib.visualization import draw_bbox2d_from_kitti, build_bbox3d_from_params, project_points_to_2d, draw_bbox3d
 
 
@@ -24,12 +26,15 @@ def get_args():
     parser.add_argument('--view_only', default=False, help='Prevent Label Changes')
     parser.add_argument('--path_timestamps', default='./timestamps.json', help='Prevent Label Changes')
     parser.add_argument('--username', default='admin', help='Enter your username to recover and save the current index.')
+    parser.add_argument('--lidar_archive_dir', default=None, help='Folder with packed lidar archives (see create_lidar_archive.py)')
+    parser.add_argument('--lidar_archive_split', default='all', help='Split name of the packed lidar archives')
+    parser.add_argument('--metadata_index', default=None, help='Metadata index of the dataset (see create_metadata_index.py)')
     return parser.parse_args()
 
 class DatasetViewer(QtGui.QMainWindow):
     def __init__(self, root_dir, topics, timedelays, can_speed_topic, can_steering_angle_topic,
                  can_light_sense_topic, can_wiper_topic, road_friction_topic, weather_topic, label_topic, name,
-                 view_only=False, key=None):
+                 view_only=False, key=None, lidar_archive_dir=None, lidar_archive_split='all', metadata_index=None):
         super(DatasetViewer, self).__init__()
 
         self.root_dir = root_dir
@@ -49,6 +54,14 @@ class DatasetViewer(QtGui.QMainWindow):
         self.boxes = []  # Needed for 3d lidar boxes plot
         self.dir_labels = 'labeltool_labels'
         self.timedelays = timedelays
+        self.lidar_archive_dir = lidar_archive_dir
+        self.lidar_archive_split = lidar_archive_split
+        self.lidar_archives = {}
+        # values shown by update_can, defined in lib/metadata.py like the metadata index
+        self.metadata_fields = dict((name, METADATA_FIELDS[name]) for name in [
+            'can/speed', 'can/steering_angle', 'can/light_sense_night', 'can/wiper', 'road_friction',
+            'weather/out_temp', 'weather/out_humidity', 'weather/dewpoint'])
+        self.metadata_index = open_metadata_index(metadata_index)
 
         print('ROOT DIR: ' + str(self.root_dir))
 
@@ -177,75 +190,65 @@ class DatasetViewer(QtGui.QMainWindow):
         self.goToIndexEdit.setText('{}'.format(self.current_index))
 
     def update_can(self):
-        self.update_speed()
-        self.update_angle()
-        self.update_daytime()
-        self.update_wiper()
-        self.update_road_friction()
-        self.update_weather()
-
-    def update_speed(self):
-        path = self.get_path('can_speed')
-        if path is None:
+        metadata = self.read_metadata()
+        self.update_speed(metadata)
+        self.update_angle(metadata)
+        self.update_daytime(metadata)
+        self.update_wiper(metadata)
+        self.update_road_friction(metadata)
+        self.update_weather(metadata)
+
+    def read_metadata(self):
+        """CAN, road friction and weather values of the current sample, missing values are None"""
+        sample_id = os.path.splitext(self.recordings[self.current_index])[0]
+        if self.metadata_index is not None and sample_id in self.metadata_index:
+            return self.metadata_index.row(sample_id)
+        return read_sample_metadata(self.root_dir, sample_id, self.metadata_fields)
+
+    def update_speed(self, metadata):
+        if metadata['can/speed'] is None:
             self.speedEdit.setText('N/A')
         else:
-            with open(path) as f:
-                can_speed = json.load(f)
-            self.speedEdit.setText('{0:.2f} km/h'.format(can_speed['VehSpd_Disp']))
+            self.speedEdit.setText('{0:.2f} km/h'.format(metadata['can/speed']))
 
-    def update_angle(self):
-        path = self.get_path('can_steering_angle')
-        if path is None:
+    def update_angle(self, metadata):
+        if metadata['can/steering_angle'] is None:
             self.angleEdit.setText('N/A')
         else:
-            with open(path) as f:
-                can_steering_angle = json.load(f)
-            self.angleEdit.setText('{0:.2f} \xb0'.format(can_steering_angle['StWhl_Angl']))
+            self.angleEdit.setText('{0:.2f} \xb0'.format(metadata['can/steering_angle']))
 
-    def update_daytime(self):
-        path = self.get_path('can_light_sense')
-        if path is None:
+    def update_daytime(self, metadata):
+        if metadata['can/light_sense_night'] is None:
             self.daytimeEdit.setText('N/A')
             self.daytime = 'night'
         else:
-            with open(path) as f:
-                can_light_sense = json.load(f)
-            if can_light_sense['LgtSens_Night'] == 1:
+            if metadata['can/light_sense_night'] == 1:
                 self.daytime = 'night'
             else:
                 self.daytime = 'day'
             self.daytimeEdit.setText('{}'.format(self.daytime))
 
-    def update_wiper(self):
-        path = self.get_path('can_wiper')
-        if path is None:
+    def update_wiper(self, metadata):
+        if metadata['can/wiper'] is None:
             self.wiperEdit.setText('N/A')
         else:
-            with open(path) as f:
-                can_wiper = json.load(f)
-            self.wiperEdit.setText('{}'.format(can_wiper['Wpr_Stat']))
+            self.wiperEdit.setText('{}'.format(metadata['can/wiper']))
 
-    def update_road_friction(self):
-        path = self.get_path('road_friction')
-        if path is None or os.path.exists(path) is False:
+    def update_road_friction(self, metadata):
+        if metadata['road_friction'] is None:
             self.roadFrictionEdit.setText('N/A')
         else:
-            with open(path) as f:
-                road_friction = json.load(f)
-            self.roadFrictionEdit.setText('{}'.format(road_friction['surface_state_result']).lower())
+            self.roadFrictionEdit.setText('{}'.format(metadata['road_friction']).lower())
 
-    def update_weather(self):
-        path = self.get_path('weather')
-        if path is None or os.path.exists(path) is False:
+    def update_weather(self, metadata):
+        if metadata['weather/out_temp'] is None:
             self.outTempEdit.setText('N/A')
             self.outHumidityEdit.setText('N/A')
             self.dewpointEdit.setText('N/A')
         else:
-            with open(path) as f:
-                weather = json.load(f)
-            self.outTempEdit.setText('{0:.2f} \xb0C'.format((weather['outTemp'] - 32.0)*5/9))
-            self.outHumidityEdit.setText('{0:.2f} %'.format(weather['outHumidity']))
-            self.dewpointEdit.setText('{0:.2f} \xb0C'.format((weather['dewpoint'] - 32.0)*5/9))
+            self.outTempEdit.setText('{0:.2f} \xb0C'.format((metadata['weather/out_temp'] - 32.0)*5/9))
+            self.outHumidityEdit.setText('{0:.2f} %'.format(metadata['weather/out_humidity']))
+            self.dewpointEdit.setText('{0:.2f} \xb0C'.format((metadata['weather/dewpoint'] - 32.0)*5/9))
 
     def update_image(self):
         self.update_calib()
@@ -393,11 +396,16 @@ class DatasetViewer(QtGui.QMainWindow):
         else:
             self.timeLidar3dEdit.setText('No timestamp found!')
 
-        pc = np.fromfile(path, dtype=np.float32)
-        try:
-            pc = pc.reshape((-1, 5))
-        except Exception:
-            pc = pc.reshape((-1, 4))
+        archive = self.get_lidar_archive(self.lidar3d_topic)
+        sample_id = os.path.splitext(self.recordings[self.current_index])[0]
+        if archive is not None and sample_id in archive:
+            pc = archive[sample_id]
+        else:
+            pc = np.fromfile(path, dtype=np.float32)
+            try:
+                pc = pc.reshape((-1, 5))
+            except Exception:
+                pc = pc.reshape((-1, 4))
 
         norm = mpl.colors.Normalize(vmin=3, vmax=80)
         cmap = cm.jet
@@ -615,6 +623,13 @@ class DatasetViewer(QtGui.QMainWindow):
         if not os.path.exists(os.path.join(self.root_dir, self.dir_labels)):
             os.mkdir(os.path.join(self.root_dir, self.dir_labels))
 
+    def get_lidar_archive(self, topic):
+        if self.lidar_archive_dir is None:
+            return None
+        if topic not in self.lidar_archives:
+            self.lidar_archives[topic] = open_lidar_archive(self.lidar_archive_dir, topic, self.lidar_archive_split)
+        return self.lidar_archives[topic]
+
     def get_path(self, topic):
         recording = self.recordings[self.current_index]
 
@@ -869,7 +884,8 @@ def main(name):
     app = QtGui.QApplication(sys.argv)
     DatasetViewer(root_dir, topics, timedelays, can_speed_topic, can_steering_angle_topic,
                   can_light_sense_topic, can_wiper_topic, road_friction_topic, weather_topic, label_topics, name,
-                  view_only=args.view_only)
+                  view_only=args.view_only, lidar_archive_dir=args.lidar_archive_dir,
+                  lidar_archive_split=args.lidar_archive_split, metadata_index=args.metadata_index)
     sys.exit(app.exec_())
 
 
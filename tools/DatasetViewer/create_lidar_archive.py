@@ -0,0 +1,41 @@
+import argparse
+import os
+import time
+
+from lib.archive import read_split_ids, write_lidar_archive, archive_paths
+
+
+def parsArgs():
+    parser = argparse.ArgumentParser(description='Pack per frame lidar .bin files into one archive per topic and split')
+    parser.add_argument('--root_path', '-r', help='Path to Dataset root directory', required=True)
+    parser.add_argument('--split', '-s', help='Split file selecting the frames, e.g. ../../splits/all.txt', required=True)
+    parser.add_argument('--topics', '-t', nargs='+', help='Lidar topics to pack',
+                        default=['lidar_hdl64_last', 'lidar_hdl64_strongest', 'lidar_vlp32_last', 'lidar_vlp32_strongest'])
+    parser.add_argument('--archive_dir', '-a', help='Output folder, defaults to <root_path>/lidar_archives', default=None)
+    return parser.parse_args()
+
+
+def main(args):
+    archive_dir = args.archive_dir or os.path.join(args.root_path, 'lidar_archives')
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+
+    split = os.path.splitext(os.path.basename(args.split))[0]
+    sample_ids = read_split_ids(args.split)
+    for topic in args.topics:
+        if not os.path.isdir(os.path.join(args.root_path, topic)):
+            print('Topic %s not found in %s, skipping' % (topic, args.root_path))
+            continue
+        start = time.time()
+        missing = write_lidar_archive(args.root_path, topic, sample_ids, archive_dir, split)
+        data_path, _ = archive_paths(archive_dir, topic, split)
+        print('%s: packed %d/%d frames (%.1f MB) in %.1fs' % (
+            topic, len(sample_ids) - len(missing), len(sample_ids), os.path.getsize(data_path) / 1e6,
+            time.time() - start))
+        if missing:
+            print('%s: %d frames missing, e.g. %s' % (topic, len(missing), missing[0]))
+
+
+if __name__ == '__main__':
+    args = parsArgs()
+    main(args)
@@ -0,0 +1,28 @@
+import argparse
+import os
+import time
+
+from lib.archive import read_split_ids
+from lib.metadata import build_metadata_index, INDEX_NAME
+
+
+def parsArgs():
+    parser = argparse.ArgumentParser(description='Consolidate the per sample metadata json files into one index')
+    parser.add_argument('--root_path', '-r', help='Path to Dataset root directory', required=True)
+    parser.add_argument('--split', '-s', help='Split file selecting the frames, defaults to all samples with metadata', default=None)
+    parser.add_argument('--index_path', '-i', help='Output file, defaults to <root_path>/%s' % INDEX_NAME, default=None)
+    return parser.parse_args()
+
+
+def main(args):
+    index_path = args.index_path or os.path.join(args.root_path, INDEX_NAME)
+    samples = read_split_ids(args.split) if args.split is not None else None
+    start = time.time()
+    n_samples = build_metadata_index(args.root_path, index_path, samples)
+    print('indexed %d samples in %.1fs, %s (%.1f kB)' % (n_samples, time.time() - start, index_path,
+                                                         os.path.getsize(index_path) / 1e3))
+
+
+if __name__ == '__main__':
+    args = parsArgs()
+    main(args)
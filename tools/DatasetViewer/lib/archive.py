@@ -0,0 +1,109 @@
+"""
+Packed lidar archive holding all scans of one topic and split in a single file.
+
+    <archive_dir>/<topic>_<split>.bin   concatenated float32 scans (N, 5) in split order
+    <archive_dir>/<topic>_<split>.json  index {sample_id: [offset, length]} in points
+
+Sample ids are the recording_frame ids used in splits/*.txt, e.g. 2018-02-03_20-48-35_00400.
+"""
+import numpy as np
+import os
+import json
+
+ARCHIVE_COLUMNS = 5
+ARCHIVE_DTYPE = np.float32
+
+
+def archive_paths(archive_dir, topic, split):
+    """Return the data and index file of the archive for topic and split"""
+    name = '%s_%s' % (topic, split)
+    return os.path.join(archive_dir, name + '.bin'), os.path.join(archive_dir, name + '.json')
+
+
+def read_split_ids(split_file):
+    """Read a split file and return the sample ids as recording_frame"""
+    with open(split_file, 'r') as f:
+        return [line.strip().replace(',', '_') for line in f if line.strip()]
+
+
+def write_lidar_archive(source_dir, topic, sample_ids, archive_dir, split):
+    """
+    Pack the per frame .bin files of topic into one archive. Missing frames are skipped and returned.
+    The data file is written to a temporary name first and moved into place together with the index.
+    """
+    data_path, index_path = archive_paths(archive_dir, topic, split)
+    index = {}
+    missing = []
+    offset = 0
+    with open(data_path + '.tmp', 'wb') as archive:
+        for sample_id in sample_ids:
+            file_path = os.path.join(source_dir, topic, sample_id + '.bin')
+            if not os.path.isfile(file_path):
+                missing.append(sample_id)
+                continue
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            length = len(data) // (ARCHIVE_COLUMNS * np.dtype(ARCHIVE_DTYPE).itemsize)
+            archive.write(data)
+            index[sample_id] = [offset, length]
+            offset += length
+
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump({'topic': topic, 'split': split, 'columns': ARCHIVE_COLUMNS, 'dtype': np.dtype(ARCHIVE_DTYPE).name,
+                   'samples': index}, f)
+    os.replace(data_path + '.tmp', data_path)
+    os.replace(index_path + '.tmp', index_path)
+    return missing
+
+
+class LidarArchive(object):
+    """
+    Read only random access to a packed lidar archive. Scans are returned as (N, 5) views into a memory map,
+    so nothing is read from disk before the points are accessed.
+    """
+
+    def __init__(self, data_path, index_path):
+        self.data_path = data_path
+        self.index_path = index_path
+        with open(index_path, 'r') as f:
+            meta = json.load(f)
+        self.topic = meta['topic']
+        self.split = meta['split']
+        self.index = meta['samples']
+        if os.path.getsize(data_path) == 0:
+            self.points = np.empty((0, meta['columns']), dtype=meta['dtype'])
+        else:
+            self.points = np.memmap(data_path, dtype=meta['dtype'], mode='r').reshape((-1, meta['columns']))
+
+    def __getstate__(self):
+        # reopen the memory map instead of pickling the points, e.g. when sent to worker processes
+        return self.data_path, self.index_path
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, sample_id):
+        return sample_id in self.index
+
+    def __getitem__(self, sample_id):
+        offset, length = self.index[sample_id]
+        return self.points[offset:offset + length]
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, sample_id, default=None):
+        if sample_id not in self.index:
+            return default
+        return self[sample_id]
+
+
+def open_lidar_archive(archive_dir, topic, split):
+    """Open the archive for topic and split, returns None if it has not been created"""
+    data_path, index_path = archive_paths(archive_dir, topic, split)
+    if not (os.path.isfile(data_path) and os.path.isfile(index_path)):
+        return None
+    return LidarArchive(data_path, index_path)
@@ -0,0 +1,182 @@
+"""
+Columnar label store. A label line consists of the class name (which may contain spaces, e.g. "traffic sign"),
+22 numeric KITTI style fields and 4 visibility flags. The objects of one frame are parsed into one numpy structured
+array with LABEL_DTYPE, a whole dataset into one array with a frame offset index (LabelStore).
+The KITTI difficulty of the objects is computed vectorized and stored with the labels.
+"""
+import numpy as np
+import os
+
+NUMERIC_FIELDS = ['truncated', 'occlusion', 'angle', 'xleft', 'ytop', 'xright', 'ybottom', 'height', 'width',
+                  'length', 'posx', 'posy', 'posz', 'orient3d', 'rotx', 'roty', 'rotz', 'score', 'qx', 'qy', 'qz', 'qw']
+VISIBILITY_FIELDS = ['visibleRGB', 'visibleGated', 'visibleLidar', 'visibleRadar']
+LABEL_DTYPE = np.dtype([('identity', 'U32')] + [(name, np.float64) for name in NUMERIC_FIELDS] +
+                       [(name, np.int8) for name in VISIBILITY_FIELDS])
+N_VALUES = len(NUMERIC_FIELDS) + len(VISIBILITY_FIELDS)
+
+# KITTI difficulty, an object gets the easiest level whose limits it satisfies and UNDEFINED_DIFFICULTY otherwise
+DIFFICULTY_TO_INT = {'easy': 0, 'moderate': 1, 'hard': 2}
+UNDEFINED_DIFFICULTY = 3
+MAX_TRUNCATION = {'easy': 0.15, 'moderate': 0.30, 'hard': 0.50}
+MAX_OCCLUSION = {'easy': 0, 'moderate': 1, 'hard': 2}
+MIN_BBOX_HEIGHT = {'easy': 40, 'moderate': 25, 'hard': 25}
+
+
+def _split_lines(lines, names, values, visible):
+    """Split label lines into class names, numeric and visibility tokens, returns the number of objects"""
+    n_objects = 0
+    for line in lines:
+        tokens = line.split()
+        if not tokens:
+            continue
+        if len(tokens) <= N_VALUES:
+            raise ValueError('Invalid label line "%s"' % line.strip())
+        names.append(' '.join(tokens[:-N_VALUES]))
+        values.extend(tokens[-N_VALUES:-len(VISIBILITY_FIELDS)])
+        visible.extend(tokens[-len(VISIBILITY_FIELDS):])
+        n_objects += 1
+    return n_objects
+
+
+def _build_objects(names, values, visible):
+    objects = np.empty(len(names), dtype=LABEL_DTYPE)
+    objects['identity'] = names
+    values = np.array(values, dtype=np.float64).reshape(-1, len(NUMERIC_FIELDS))
+    for idx, name in enumerate(NUMERIC_FIELDS):
+        objects[name] = values[:, idx]
+    # True -> 1, False -> 0, anything else -> -1
+    visible = np.array(visible).reshape(-1, len(VISIBILITY_FIELDS))
+    visible = np.where(visible == 'True', 1, np.where(visible == 'False', 0, -1))
+    for idx, name in enumerate(VISIBILITY_FIELDS):
+        objects[name] = visible[:, idx]
+    return objects
+
+
+def parse_labels(lines):
+    """Parse label lines into a structured array with LABEL_DTYPE"""
+    names, values, visible = [], [], []
+    _split_lines(lines, names, values, visible)
+    return _build_objects(names, values, visible)
+
+
+def read_label_file(label_file):
+    """Read one label file into a structured array with LABEL_DTYPE"""
+    with open(label_file, 'r') as f:
+        return parse_labels(f)
+
+
+def bbox_height(objects):
+    """Height of the 2d boxes in pixels, measured on the rounded box corners"""
+    return np.round(objects['ybottom']) - np.round(objects['ytop'])
+
+
+def assign_difficulty(truncation, occlusion, height, max_truncation=MAX_TRUNCATION, max_occlusion=MAX_OCCLUSION,
+                      min_bbox_height=MIN_BBOX_HEIGHT, difficulty_to_int=DIFFICULTY_TO_INT):
+    """Difficulty level of every object from arrays of truncation, occlusion and 2d box height"""
+    truncation = np.asarray(truncation, dtype=np.float64)
+    occlusion = np.asarray(occlusion, dtype=np.float64)
+    height = np.asarray(height, dtype=np.float64)
+    difficulty = np.full(truncation.shape, UNDEFINED_DIFFICULTY, dtype=np.int8)
+    # easier levels are assigned last and overwrite harder ones
+    for mode in ['hard', 'moderate', 'easy']:
+        satisfied = (truncation <= max_truncation[mode]) & (occlusion <= max_occlusion[mode]) & \
+                    (height >= min_bbox_height[mode])
+        difficulty[satisfied] = difficulty_to_int[mode]
+    return difficulty
+
+
+def label_difficulty(objects):
+    """Difficulty level of every object of a structured label array"""
+    return assign_difficulty(objects['truncated'], objects['occlusion'], bbox_height(objects))
+
+
+def visibility_to_bool(values):
+    """Map visibility flags back to True, False and None"""
+    return [None if value < 0 else bool(value) for value in values.tolist()]
+
+
+class LabelStore(object):
+    """
+    Labels of many frames in one structured array. The objects of frame i are objects[offsets[i]:offsets[i + 1]],
+    store[frame] returns them as a view. difficulty holds the KITTI difficulty of every object.
+    """
+
+    def __init__(self, frames, offsets, objects, difficulty=None):
+        self.frames = list(frames)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.objects = objects
+        self.difficulty = label_difficulty(objects) if difficulty is None else np.asarray(difficulty, dtype=np.int8)
+        self.index = {frame: idx for idx, frame in enumerate(self.frames)}
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame):
+        return frame in self.index
+
+    def __getitem__(self, frame):
+        idx = self.index[frame]
+        return self.objects[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get_difficulty(self, frame):
+        idx = self.index[frame]
+        return self.difficulty[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def keys(self):
+        return self.index.keys()
+
+    def frame_ids(self):
+        """Frame index of every object"""
+        return np.repeat(np.arange(len(self.frames)), np.diff(self.offsets))
+
+    def select(self, frames):
+        """Indices of all objects of the given frames, unknown frames are ignored"""
+        idx = np.array([self.index[frame] for frame in frames if frame in self.index], dtype=np.int64)
+        starts, lengths = self.offsets[idx], self.offsets[idx + 1] - self.offsets[idx]
+        # position of every selected object within its frame added to the start of the frame
+        first = np.cumsum(lengths) - lengths
+        return np.repeat(starts - first, lengths) + np.arange(lengths.sum())
+
+    def save(self, path):
+        # written through a file object, np.savez would append .npz to the name otherwise
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, frames=np.array(self.frames), offsets=self.offsets, objects=self.objects,
+                     difficulty=self.difficulty)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            difficulty = data['difficulty'] if 'difficulty' in data else None
+            return cls(data['frames'].tolist(), data['offsets'], data['objects'], difficulty)
+
+
+def is_cache_valid(cache_file, label_dir, frames):
+    """A label cache is valid if it is not older than any of the label files"""
+    if not os.path.isfile(cache_file):
+        return False
+    cache_time = os.path.getmtime(cache_file)
+    return all(os.path.getmtime(os.path.join(label_dir, frame + '.txt')) <= cache_time for frame in frames)
+
+
+def load_label_store(label_dir, frames=None, cache_file=None):
+    """
+    Parse the label files of a folder (or of the given frame ids) into one LabelStore.
+    The tokens of all files are collected first and converted in one pass. With cache_file the store including the
+    difficulty levels is loaded from there if it is up to date and written there otherwise.
+    """
+    if frames is None:
+        frames = sorted(os.path.splitext(f)[0] for f in os.listdir(label_dir) if f.endswith('.txt'))
+    if cache_file is not None and is_cache_valid(cache_file, label_dir, frames):
+        store = LabelStore.load(cache_file)
+        if store.frames == list(frames):
+            return store
+    names, values, visible = [], [], []
+    offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+    for idx, frame in enumerate(frames):
+        with open(os.path.join(label_dir, frame + '.txt'), 'r') as f:
+            offsets[idx + 1] = offsets[idx] + _split_lines(f, names, values, visible)
+    store = LabelStore(frames, offsets, _build_objects(names, values, visible))
+    if cache_file is not None:
+        store.save(cache_file)
+    return store
@@ -0,0 +1,158 @@
+"""
+Metadata index consolidating the small per sample json files (CAN, road friction, weather station and the daytime of
+the label tool) into one .npz table, so that consumers do a dictionary lookup instead of opening several files per frame.
+
+    <root>/metadata_index.npz   samples: sorted sample ids, one column per field of METADATA_FIELDS
+
+Float fields are stored as float64 columns with nan for missing values. Int and bool fields keep their type (int64 and
+bool columns), their missing values are marked in a separate present/<field> column. All other fields are stored as
+string columns with '' for missing values. Sample ids are the recording_frame ids used in splits/*.txt, e.g. 2018-02-03_20-48-35_00400.
+"""
+import numpy as np
+import os
+import json
+
+# field name: (folder, json key path)
+METADATA_FIELDS = {
+    'can/speed': ('filtered_relevant_can_data/can_body_basic', ('VehSpd_Disp',)),
+    'can/steering_angle': ('filtered_relevant_can_data/can_body_chassis', ('StWhl_Angl',)),
+    'can/light_sense_night': ('filtered_relevant_can_data/can_body_lightsense', ('LgtSens_Night',)),
+    'can/wiper': ('filtered_relevant_can_data/can_body_wiper', ('Wpr_Stat',)),
+    'road_friction': ('road_friction', ('surface_state_result',)),
+    'weather/out_temp': ('weather_station', ('outTemp',)),
+    'weather/out_humidity': ('weather_station', ('outHumidity',)),
+    'weather/dewpoint': ('weather_station', ('dewpoint',)),
+    'label/day': ('labeltool_labels', ('daytime', 'day')),
+}
+INDEX_NAME = 'metadata_index.npz'
+
+
+def _lookup(data, key_path):
+    for key in key_path:
+        data = data[key]
+    return data
+
+
+def read_sample_metadata(root_dir, sample_id, fields=METADATA_FIELDS):
+    """Read the fields of one sample from the json files, every file is parsed once. Missing values are None."""
+    files = {}
+    metadata = {}
+    for name, (folder, key_path) in fields.items():
+        if folder not in files:
+            path = os.path.join(root_dir, folder, sample_id + '.json')
+            files[folder] = None
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    files[folder] = json.load(f)
+        try:
+            metadata[name] = _lookup(files[folder], key_path)
+        except (KeyError, TypeError, IndexError):
+            metadata[name] = None
+    return metadata
+
+
+def list_samples(root_dir, fields=METADATA_FIELDS):
+    """Sample ids of all json files in the folders of fields"""
+    samples = set()
+    for folder in set(folder for folder, _ in fields.values()):
+        if os.path.isdir(os.path.join(root_dir, folder)):
+            samples.update(os.path.splitext(f)[0] for f in os.listdir(os.path.join(root_dir, folder))
+                           if f.endswith('.json'))
+    return sorted(samples)
+
+
+PRESENT_PREFIX = 'present/'
+
+
+def _is_number(value):
+    return isinstance(value, (bool, int, float))
+
+
+def _column_dtype(values):
+    """Column type of the present values of a field, bool and int are kept to return the json types"""
+    if all(isinstance(value, bool) for value in values):
+        return np.bool_
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+        return np.int64
+    if all(_is_number(value) for value in values):
+        return np.float64
+    return str
+
+
+def build_metadata_index(root_dir, index_path=None, samples=None, fields=METADATA_FIELDS):
+    """Read the metadata of all samples and write the index, returns the number of indexed samples"""
+    index_path = index_path or os.path.join(root_dir, INDEX_NAME)
+    samples = list_samples(root_dir, fields) if samples is None else sorted(samples)
+    values = dict((name, []) for name in fields)
+    for sample_id in samples:
+        for name, value in read_sample_metadata(root_dir, sample_id, fields).items():
+            values[name].append(value)
+
+    columns = {'samples': np.array(samples, dtype=str)}
+    for name, column in values.items():
+        dtype = _column_dtype([value for value in column if value is not None])
+        if dtype is np.float64:
+            columns[name] = np.array([np.nan if value is None else float(value) for value in column], dtype=np.float64)
+        elif dtype is str:
+            columns[name] = np.array(['' if value is None else str(value) for value in column], dtype=str)
+        else:
+            columns[name] = np.array([0 if value is None else value for value in column], dtype=dtype)
+            columns[PRESENT_PREFIX + name] = np.array([value is not None for value in column], dtype=np.bool_)
+    with open(index_path + '.tmp', 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(index_path + '.tmp', index_path)
+    return len(samples)
+
+
+class MetadataIndex(object):
+    """In memory metadata table with O(1) lookups by sample id"""
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        with np.load(index_path) as data:
+            self.columns = dict((name, data[name]) for name in data.files
+                                if name != 'samples' and not name.startswith(PRESENT_PREFIX))
+            self.present = dict((name[len(PRESENT_PREFIX):], data[name]) for name in data.files
+                                if name.startswith(PRESENT_PREFIX))
+            samples = data['samples'].tolist()
+        self.index = dict((sample_id, row) for row, sample_id in enumerate(samples))
+
+    def __getstate__(self):
+        return self.index_path
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, sample_id):
+        return sample_id in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, sample_id, field, default=None):
+        """Value of field for sample_id, default if the sample or the value is missing"""
+        row = self.index.get(sample_id)
+        if row is None or field not in self.columns:
+            return default
+        if field in self.present and not self.present[field][row]:
+            return default
+        value = self.columns[field][row].item()
+        if value == '' or (isinstance(value, float) and np.isnan(value)):
+            return default
+        return value
+
+    def row(self, sample_id):
+        """All fields of sample_id, missing values are None"""
+        return dict((field, self.get(sample_id, field)) for field in self.columns)
+
+
+def open_metadata_index(index_path):
+    """Open the metadata index, returns None if no index_path is given"""
+    if index_path is None:
+        return None
+    if not os.path.isfile(index_path):
+        raise IOError('Metadata index %s does not exist, create it with create_metadata_index.py' % index_path)
+    return MetadataIndex(index_path)
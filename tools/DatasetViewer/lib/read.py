@@ -2,6 +2,7 @@ import numpy as np
 import os
 import json
 from pyquaternion import Quaternion
+from .labels import read_label_file, visibility_to_bool, NUMERIC_FIELDS, VISIBILITY_FIELDS
 
 
 def read_label(file, label_dir, camera_to_velodyne=None):
@@ -23,66 +24,81 @@ def decode_visible_labels(value):
 
 def get_kitti_object_list(label_file, camera_to_velodyne=None):
     """Create dict for all objects of the label file, objects are labeled w.r.t KITTI definition"""
-    kitti_object_list = []
-
     try:
-        with open(label_file.replace('.png', '.txt'), 'r') as file:
-            for line in file:
-                line = line.replace('\n', '')  # remove '\n'
-                kitti_properties = line.split(' ')
-
-                object_dict = {
-                    'identity': kitti_properties[0],
-                    'truncated': float(kitti_properties[1]),
-                    'occlusion': float(kitti_properties[2]),
-                    'angle': float(kitti_properties[3]),
-                    'xleft': int(round(float(kitti_properties[4]))),
-                    'ytop': int(round(float(kitti_properties[5]))),
-                    'xright': int(round(float(kitti_properties[6]))),
-                    'ybottom': int(round(float(kitti_properties[7]))),
-                    'height': float(kitti_properties[8]),
-                    'width': float(kitti_properties[9]),
-                    'length': float(kitti_properties[10]),
-                    'posx': float(kitti_properties[11]),
-                    'posy': float(kitti_properties[12]),
-                    'posz': float(kitti_properties[13]),
-                    'orient3d': float(kitti_properties[14]),
-                    'rotx': float(kitti_properties[15]),
-                    'roty': float(kitti_properties[16]),
-                    'rotz': float(kitti_properties[17]),
-                    'score': float(kitti_properties[18]),
-                    'qx': float(kitti_properties[19]),
-                    'qy': float(kitti_properties[20]),
-                    'qz': float(kitti_properties[21]),
-                    'qw': float(kitti_properties[22]),
-                    'visibleRGB': decode_visible_labels(kitti_properties[23]),
-                    'visibleGated': decode_visible_labels(kitti_properties[24]),
-                    'visibleLidar': decode_visible_labels(kitti_properties[25]),
-                    'visibleRadar': decode_visible_labels(kitti_properties[26]),
-                }
-
-                if camera_to_velodyne is not None:
-                    pos = np.asarray([object_dict['posx'], object_dict['posy'], object_dict['posz'], 1])
-                    pos_lidar = np.matmul(camera_to_velodyne, pos.T)
-                    object_dict['posx_lidar'] = pos_lidar[0]
-                    object_dict['posy_lidar'] = pos_lidar[1]
-                    object_dict['posz_lidar'] = pos_lidar[2]
-
-                kitti_object_list.append(object_dict)
-
-            return kitti_object_list
-
+        objects = read_label_file(label_file.replace('.png', '.txt'))
     except:
         print('Problem occurred when reading label file!')
         return []
 
+    columns = {'identity': objects['identity'].tolist()}
+    for name in NUMERIC_FIELDS:
+        columns[name] = objects[name].tolist()
+    for name in ['xleft', 'ytop', 'xright', 'ybottom']:
+        columns[name] = np.round(objects[name]).astype(int).tolist()
+    for name in VISIBILITY_FIELDS:
+        columns[name] = visibility_to_bool(objects[name])
+
+    if camera_to_velodyne is not None:
+        pos = np.stack([objects['posx'], objects['posy'], objects['posz'], np.ones(len(objects))], axis=1)
+        pos_lidar = np.matmul(pos, np.asarray(camera_to_velodyne).T)
+        columns['posx_lidar'], columns['posy_lidar'], columns['posz_lidar'] = pos_lidar[:, 0:3].T.tolist()
+
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+# Column layout of the velodyne .bin files
+VELODYNE_FIELDS = ('x', 'y', 'z', 'intensity', 'ring')
+VELODYNE_DTYPE = np.dtype([(name, np.float32) for name in VELODYNE_FIELDS])
 
-def load_velodyne_scan(file):
-    """Load and parse velodyne binary file"""
-    scan = np.fromfile(file, dtype=np.float32)
+
+def load_velodyne_scan(file, mmap=False):
+    """Load and parse velodyne binary file, with mmap=True the file is memory-mapped read-only"""
+    if mmap:
+        scan = np.memmap(file, dtype=np.float32, mode='r')
+    else:
+        scan = np.fromfile(file, dtype=np.float32)
     return scan.reshape((-1, 5))  # [:, :4]
 
 
+def velodyne_columns(scan):
+    """Return zero-copy views xyz (N, 3), intensity (N,) and ring (N,) of a (N, 5) scan"""
+    return scan[:, 0:3], scan[:, 3], scan[:, 4]
+
+
+def velodyne_structured(scan):
+    """Return a zero-copy structured view of a contiguous (N, 5) scan with the fields of VELODYNE_DTYPE"""
+    return scan.view(VELODYNE_DTYPE).reshape(-1)
+
+
+class VelodyneArena(object):
+    """
+    Many velodyne scans loaded into one contiguous (total_points, 5) float32 array.
+    Scan i occupies the rows offsets[i]:offsets[i + 1] and is returned as a view by arena[i] or arena[sample_name].
+    """
+
+    def __init__(self, files):
+        self.names = [os.path.splitext(os.path.basename(file))[0] for file in files]
+        self.index = {name: idx for idx, name in enumerate(self.names)}
+        self.offsets = np.zeros(len(files) + 1, dtype=np.int64)
+        np.cumsum([os.path.getsize(file) // VELODYNE_DTYPE.itemsize for file in files], out=self.offsets[1:])
+        self.points = np.empty((self.offsets[-1], 5), dtype=np.float32)
+        for idx, file in enumerate(files):
+            with open(file, 'rb') as f:
+                f.readinto(self.points[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, key):
+        idx = self.index[key] if isinstance(key, str) else key
+        return self.points[self.offsets[idx]:self.offsets[idx + 1]]
+
+
+def load_velodyne_scans(files):
+    """Batch load many velodyne scans into one VelodyneArena without per file allocation"""
+    return VelodyneArena(files)
+
+
 def load_radar_points(path):
     with open(path, 'r') as f:
         data = json.load(f)
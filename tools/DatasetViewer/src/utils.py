@@ -9,29 +9,8 @@ import glob
 import json
 
 def create_lut_from_kneepoints(kneepoints, bit_depth=16):
-    lut_kneepoints = kneepoints[:]
-    start_point = [0,0]
-    end_point = [2**bit_depth, 2**bit_depth]
-    lut_kneepoints.append(end_point)
-    lut =  np.zeros((2**bit_depth,), dtype=np.uint16)
-
-
-    counter = 0
-    for idx, kneepoint in enumerate(lut_kneepoints):
-        if counter == 0:
-            first_point = start_point
-            second_point = kneepoint
-        else:
-            first_point = lut_kneepoints[idx-1]
-            second_point = lut_kneepoints[idx]
-        counter += 1
-
-        m = (second_point[1] - first_point[1])/(float(second_point[0] - first_point[0]))
-        c = first_point[1] - m*first_point[0]
-
-        lut[first_point[0]:second_point[0]] = np.floor(m*np.arange(first_point[0],second_point[0]) + c).astype(np.uint16)
-
-    return lut
+    from tools.Raw2LUTImages.conversion_lib.lut_bank import build_lut_from_kneepoints
+    return build_lut_from_kneepoints(kneepoints, bit_depth=bit_depth)
 
 
 def colorize_pointcloud(depth, min_distance=3, max_distance=80, radius=3):
@@ -95,12 +74,13 @@ def apply_clahe_8bit(image):
 
 
 def image_processing(img, daytime, decomp):
-    # This has to be initialized once
+    # the LUTs are built once per process and memoized by the lut bank
+    from tools.Raw2LUTImages.conversion_lib.lut_bank import get_lut
     bit_depth = 16
     kneepoints_day = [[fb(0.005), fb(0.05)], [fb(0.01), fb(0.2)], [fb(0.03), fb(0.35)], [fb(0.05), fb(0.4)], [fb(0.1), fb(0.5)], [fb(0.2), fb(0.7)], [fb(0.3), fb(0.8)], [fb(0.4), fb(0.9)], [fb(0.5), fb(0.98)]]
     kneepoints_night = [[fb(0.0025), fb(0.1)], [fb(0.005), fb(0.25)], [fb(0.01), fb(0.4)], [fb(0.1), fb(0.8)], [fb(0.2), fb(0.9)], [fb(0.3), fb(0.98)]]
-    lut_night = create_lut_from_kneepoints(kneepoints_night, bit_depth=bit_depth)
-    lut_day = create_lut_from_kneepoints(kneepoints_day, bit_depth=bit_depth)
+    lut_night = get_lut(kneepoints_night, bit_depth=bit_depth)
+    lut_day = get_lut(kneepoints_day, bit_depth=bit_depth)
 
     # decompand (create linear 16bit image from 12bit image)
     img = decomp.processImage(img)
@@ -119,7 +99,15 @@ def image_processing(img, daytime, decomp):
     return img
 
 
-def get_daytime_from_can(root_dir, recording, sample):
+def get_daytime_from_can(root_dir, recording, sample, metadata_index=None, sample_id=None):
+    # O(1) lookup in the metadata index (see lib/metadata.py) if the sample has been indexed, the index is keyed by
+    # the dataset sample id (recording_frame), which can not be derived from the raw recording and sample names
+    if metadata_index is not None:
+        if sample_id is None:
+            raise ValueError('get_daytime_from_can needs the sample_id to look up the metadata index')
+        light_sense_night = metadata_index.get(sample_id, 'can/light_sense_night')
+        if light_sense_night is not None:
+            return 'night' if light_sense_night == 1 else 'day'
 
     try:
         path = glob.glob(os.path.join(root_dir, recording, 'can/body/w222_body_can_2016_17a/LgtSens_State_AR', sample.split('_')[0] + '_*'))[0]
@@ -2,13 +2,17 @@ import numpy as np
 import json
 import os
 import cv2
+from tools.Raw2LUTImages.conversion_lib.rectification import get_rectification_maps
 
 class CameraInfo:
     pass
 
 class CameraModel:
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, map_type='float32', persist_maps=False):
+        # rectification maps are computed on first use, see tools/Raw2LUTImages/conversion_lib/rectification.py
+        self.map_type = map_type
+        self.calib_file = file_path if persist_maps else None
         if os.path.splitext(file_path)[1] == '.ini':
             self.from_ini_file(file_path)
         elif os.path.splitext(file_path)[1] == '.json':
@@ -82,38 +86,37 @@ class CameraModel:
         self.width = int(dict['width'])
         self.rect_mat44 = np.identity(4)
         self.rect_mat44[0:3, 0:3] = self.R
+        # pixel rays of image2pointcloud, computed on first use
+        self.rays = None
+        self.pixel_indices = None
 
     def rectifyImage(self, image):
-        # taken from image_geometry.PinholeCameraModel (ROS)
-        mapx = np.ndarray(shape=(self.height, self.width, 1), dtype='float32')
-        mapy = np.ndarray(shape=(self.height, self.width, 1), dtype='float32')
-        cv2.initUndistortRectifyMap(self.K, self.D, self.R, self.P, (self.width, self.height), cv2.CV_32FC1, mapx, mapy)
+        # taken from image_geometry.PinholeCameraModel (ROS), the maps are cached per calibration
+        mapx, mapy = get_rectification_maps(self.K, self.D, self.R, self.P, (self.width, self.height), self.map_type,
+                                             self.calib_file)
         image_rect = cv2.remap(image, mapx, mapy, cv2.INTER_CUBIC)
 
         return image_rect
 
-    def image2pointcloud(self, image_rect, depth):
-
-        # Depth to 3D points
-        idx = np.indices((self.height, self.width))
-        index_matrix = np.vstack((idx[1].flatten(), idx[0].flatten(),np.ones((self.height * self.width,))))
-        inv_proj_mat = np.linalg.inv(np.array(self.P[:, 0:3]))
-        # print(self.height, self.width)
-        pc = np.multiply(np.dot(inv_proj_mat, index_matrix), depth.flatten())
-
-        # pc = np.r_[pc, np.ones((1, pc.shape[1]))]
-        # pc = np.dot(np.transpose(self.rect_mat44), pc)
-        # pc = pc[0:3, :]
-
-        # points_stereo = np.multiply(np.matmul(inv_proj_mat, index_matrix), depth.flatten())
+    def pixel_rays(self):
+        """
+        Rays inv(P[:, 0:3]) * (u, v, 1) of all pixels as float32 (3, height*width) array and the pixel indices
+        np.indices((height, width)). Both only depend on the calibration and are computed once.
+        """
+        if self.rays is None:
+            idx = np.indices((self.height, self.width))
+            index_matrix = np.vstack((idx[1].flatten(), idx[0].flatten(), np.ones((self.height * self.width,))))
+            inv_proj_mat = np.linalg.inv(np.array(self.P[:, 0:3]))
+            self.rays = np.dot(inv_proj_mat, index_matrix).astype(np.float32)
+            self.rays.setflags(write=False)
+            idx.setflags(write=False)
+            self.pixel_indices = idx
+        return self.rays, self.pixel_indices
 
+    def image2pointcloud(self, image_rect, depth):
 
-        # x = (uv[0] - self.cx()) / self.fx()
-        # y = (uv[1] - self.cy()) / self.fy()
-        # norm = math.sqrt(x * x + y * y + 1)
-        # x /= norm
-        # y /= norm
-        # z = 1.0 / norm
-        # return (x, y, z)
+        # Depth to 3D points, the depth scales the cached pixel rays
+        rays, idx = self.pixel_rays()
+        pc = np.multiply(rays, np.reshape(depth, (1, -1)), dtype=np.float32)
 
-        return pc, idx
\ No newline at end of file
+        return pc, idx
@@ -91,6 +91,7 @@ class ImageTransformer:
         self.target_cam_model = CameraModel(target_cam_file)
         if source_cam_file_stereo:
             self.source_cam_model_stereo = CameraModel(source_cam_file_stereo)
+        self.depth_warp = None
 
     def transform_with_disparity(self, source_image, disparity, baseline):
 
@@ -188,39 +189,74 @@ class ImageTransformer:
 
         return out
 
-    def transform_with_target_depth(self, source_image, target_image, depth, vehicle_speed=0, delay=0, angle=0):
-
-        source_image = source_image.copy()
-        source_image_rect = source_image
-
-        # Depth to 3D points
-        pc, idx = self.target_cam_model.image2pointcloud(source_image_rect, depth)
-        points_target = np.vstack((pc, np.ones((1,pc.shape[1]))))
-        points_source = np.matmul(self.mat44_inv, points_target)
-        points_source[2,:] = points_source[2,:] - np.cos(angle*np.pi/180)*vehicle_speed*delay
-        points_source[1,:] = points_source[1,:] + np.sin(angle*np.pi/180)*vehicle_speed*delay
-
-
-        # project 3D points into gated frame
-        coordinates_hom_target = np.matmul(np.array(self.target_cam_model.P), points_target) # should be equal to idx
-        coordinates_hom_source = np.matmul(np.array(self.source_cam_model.P), points_source)
-        coordinates_t = coordinates_hom_target[:-1, :] / coordinates_hom_target[-1, :]
-        coordinates_t = np.round(coordinates_t).astype(int)
-        coordinates_s = coordinates_hom_source[:-1, :] / coordinates_hom_source[-1, :]
-        coordinates_s = np.round(coordinates_s).astype(int)
-
-        valid_t = np.logical_and(np.logical_and(coordinates_t[0] >= 0, coordinates_t[0] < self.target_cam_model.width),
-                               np.logical_and(coordinates_t[1] >= 0, coordinates_t[1] < self.target_cam_model.height))
-        valid_s = np.logical_and(np.logical_and(coordinates_s[0] >= 0, coordinates_s[0] < self.source_cam_model.width),
-                               np.logical_and(coordinates_s[1] >= 0, coordinates_s[1] < self.source_cam_model.height))
-
-        out = np.zeros((self.target_cam_model.height, self.target_cam_model.width, 3), dtype=source_image.dtype)
-
-        coordinates_s = coordinates_s[:, valid_s]
-        coordinates_t = coordinates_t[:, valid_s]
-        out[coordinates_t[1], coordinates_t[0], :] = source_image_rect[coordinates_s[1].flatten(), coordinates_s[0].flatten(), :]
-
-        return out
+    def target_depth_warp(self):
+        """DepthWarp from the source into the target camera, created on first use"""
+        if self.depth_warp is None:
+            self.depth_warp = DepthWarp(self.source_cam_model, self.target_cam_model, self.mat44_inv)
+        return self.depth_warp
 
+    def transform_with_target_depth(self, source_image, target_image, depth, vehicle_speed=0, delay=0, angle=0,
+                                    interpolation='nearest'):
+        # source image must be rectified, see transform_with_depth. The depth is given for every target pixel.
+        return self.target_depth_warp().warp(source_image, depth, vehicle_speed=vehicle_speed, delay=delay, angle=angle,
+                                             interpolation=interpolation)
 
 
+class DepthWarp:
+    """
+    Warps a source image into the target camera given the depth of every target pixel.
+
+    A target pixel (u, v) with depth d lies at d * inv(P_t[:, 0:3]) * (u, v, 1) in the target frame. Extrinsics,
+    ego-motion offset and the source projection P_s are folded into one 3x4 matrix per frame
+        M = P_s * [R | t + offset],  (x, y, w) = M * (d * inv(P_t[:, 0:3]) * (u, v, 1), 1)
+    The left 3x3 block only depends on the calibration, so it is applied once to the pixel rays of the target camera.
+    Per frame the source coordinates x/w, y/w are two multiply-adds and a division per pixel, they are returned as
+    float32 maps and sampled with cv2.remap.
+    """
+    INTERPOLATIONS = {'nearest': cv2.INTER_NEAREST, 'bilinear': cv2.INTER_LINEAR}
+
+    def __init__(self, source_cam_model, target_cam_model, target_to_source):
+        self.source_cam_model = source_cam_model
+        self.target_cam_model = target_cam_model
+        self.target_to_source = np.array(target_to_source, dtype=np.float64)
+        P_s = np.array(source_cam_model.P, dtype=np.float64)
+        rays, _ = target_cam_model.pixel_rays()
+        # M[:, 0:3] * ray of every target pixel, (3, height, width)
+        self.projected_rays = np.dot(np.dot(P_s[:, 0:3], self.target_to_source[0:3, 0:3]), rays).astype(np.float32)
+        self.projected_rays = self.projected_rays.reshape((3, target_cam_model.height, target_cam_model.width))
+        self.projected_rays.setflags(write=False)
+
+    def warp_matrix(self, vehicle_speed=0, delay=0, angle=0):
+        """3x4 matrix from target points (x, y, z, 1) to homogeneous source pixels, angle in degrees"""
+        P_s = np.array(self.source_cam_model.P, dtype=np.float64)
+        # ego-motion during delay, moves the points backwards in z and sideways in y of the source frame
+        translation = self.target_to_source[0:3, 3] + np.array(
+            [0, np.sin(angle * np.pi / 180) * vehicle_speed * delay, -np.cos(angle * np.pi / 180) * vehicle_speed * delay])
+        M = np.zeros((3, 4))
+        M[:, 0:3] = np.dot(P_s[:, 0:3], self.target_to_source[0:3, 0:3])
+        M[:, 3] = np.dot(P_s[:, 0:3], translation) + P_s[:, 3]
+        return M
+
+    def maps(self, depth, vehicle_speed=0, delay=0, angle=0):
+        """Source pixel coordinates of every target pixel as float32 (height, width) maps for cv2.remap"""
+        M = self.warp_matrix(vehicle_speed, delay, angle)
+        depth = np.asarray(depth, dtype=np.float32).reshape(self.projected_rays.shape[1:])
+        w = self.projected_rays[2] * depth
+        w += np.float32(M[2, 3])
+        map_x = self.projected_rays[0] * depth
+        map_x += np.float32(M[0, 3])
+        map_x /= w
+        map_y = self.projected_rays[1] * depth
+        map_y += np.float32(M[1, 3])
+        map_y /= w
+        # pixels without a valid depth are mapped outside of the source image
+        invalid = ~(np.isfinite(map_x) & np.isfinite(map_y))
+        map_x[invalid] = -1
+        map_y[invalid] = -1
+        return map_x, map_y
+
+    def warp(self, source_image, depth, vehicle_speed=0, delay=0, angle=0, interpolation='nearest'):
+        """Target image of the source image, pixels mapped outside of the source image are 0"""
+        map_x, map_y = self.maps(depth, vehicle_speed, delay, angle)
+        return cv2.remap(source_image, map_x, map_y, self.INTERPOLATIONS[interpolation],
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
@@ -3,6 +3,7 @@ from tools.ProjectionTools.Gated2RGB.lib.data_loader import load_vehicle_speed,
 from tools.Raw2LUTImages.conversion_lib.process import Rectify_image
 from tools.CreateTFRecords.generic_tf_tools.resize import resize
 from tools.ProjectionTools.Gated2RGB.lib.image_transformer import disparity2depth_psm
+from tools.DatasetFoggification.depth_cache import load_dense_map
 import cv2
 import os
 import numpy as np
@@ -56,6 +57,14 @@ class DepthWarpingWrapper():
                 dist_images_shape[folder] = ([img_height, img_width, 3])
 
 
+        disparity = load_dense_map(os.path.join(self.source_dir, self.depth_folder, entry_id + '.npz'), key='arr_0')
+        if 'psmnet' in self.depth_folder:
+            # Take care PSMNet was trained on half the resolution! Therefore, the disparity has to be multiplied by two!!
+            # Also the cam_stereo_sgm disparity maps are caclulated on half the resolution
+            depth_single = cv2.resize(disparity2depth_psm(2*disparity.astype(np.float32)), (1920, 1024)) #
+        else:
+            depth_single = cv2.resize(disparity2depth_psm(disparity.astype(np.float32)), (1920, 1024)) #
+
         for folder in self.gated_keys:
             file_path = os.path.join(self.source_dir, folder, entry_id + '.tiff')
             if self.DEBUG==True:
@@ -66,13 +75,6 @@ class DepthWarpingWrapper():
             img = img[:,:, np.newaxis]
             img = np.concatenate([img]*3, axis=2)
 
-            if 'psmnet' in self.depth_folder:
-                # Take care PSMNet was trained on half the resolution! Therefore, the disparity has to be multiplied by two!!
-                # Also the cam_stereo_sgm disparity maps are caclulated on half the resolution
-                depth_single = cv2.resize(disparity2depth_psm(2*np.load(os.path.join(self.source_dir, self.depth_folder, entry_id + '.npz'))['arr_0']), (1920, 1024)) #
-            else:
-                depth_single = cv2.resize(disparity2depth_psm(np.load(os.path.join(self.source_dir, self.depth_folder, entry_id + '.npz'))['arr_0']), (1920, 1024)) #
-
             img = self.WarpGated.process_image_ego_motion((768, 1280), img, depth_single, vehicle_speed, angle, delay[folder.split('_')[0]], self.RG.PC.K)
             gated_images[folder] = img
             gated_images_shape[folder] = ([img_height, img_width, 1])
@@ -0,0 +1,57 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from conversion_lib.basic_utils import read_image_intrinsic
+from conversion_lib.pinhole_camera_model import PinholeCameraModel
+from conversion_lib.rectification import compute_rectification_maps, get_rectification_maps
+
+
+def parsArgs():
+    parser = argparse.ArgumentParser(description='Compare per frame cost of computed and cached rectification maps')
+    parser.add_argument('--root', '-r', help='Enter the root folder', default='./example_data/')
+    parser.add_argument('--cam_files', '-c', nargs='+', help='Calibration files',
+                        default=['calib_cam_stereo_left.json', 'calib_cam_stereo_right.json', 'calib_gated_bwv.json'])
+    parser.add_argument('--repeat', '-n', type=int, help='Number of timed frames per method', default=10)
+    return parser.parse_args()
+
+
+def timeit(function, repeat):
+    result = function()
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    return result, (time.time() - start) / repeat
+
+
+def main(args):
+    for cam_file in args.cam_files:
+        PC = PinholeCameraModel()
+        PC.fromJsonDict(read_image_intrinsic(args.root, cam_file))
+        size = (PC.width, PC.height)
+        # raw gated images are single channel 10 bit, the debayered camera images 3 channel 12 bit
+        if 'gated' in cam_file:
+            image = np.random.randint(0, 2**10, size=(PC.height, PC.width), dtype=np.uint16)
+        else:
+            image = np.random.randint(0, 2**12, size=(PC.height, PC.width, 3), dtype=np.uint16)
+
+        def per_frame():
+            mapx, mapy = compute_rectification_maps(PC.K, PC.D, PC.R, PC.P, size)
+            return cv2.remap(image, mapx, mapy, cv2.INTER_AREA)
+
+        reference, reference_time = timeit(per_frame, args.repeat)
+        print('%s %dx%d' % (cam_file, PC.width, PC.height))
+        print('  %-22s %8.1f ms' % ('maps per frame', reference_time * 1000))
+        for map_type in ['float32', 'fixed']:
+            mapx, mapy = get_rectification_maps(PC.K, PC.D, PC.R, PC.P, size, map_type)
+            rectified, cached_time = timeit(lambda: cv2.remap(image, mapx, mapy, cv2.INTER_AREA), args.repeat)
+            print('  %-22s %8.1f ms  speedup %5.1fx  max abs error %d' % (
+                'cached %s maps' % map_type, cached_time * 1000, reference_time / cached_time,
+                np.max(np.abs(rectified.astype(np.int32) - reference))))
+
+
+if __name__ == '__main__':
+    args = parsArgs()
+    main(args)
@@ -26,21 +26,16 @@ def loadKneepoints(kneepoints_list, bitdepth=16):
 
 def create_decompand_lut(kneepoints, DEBUG=False):
 
-    decompanded = 0
     src_min = 0
     dst_min = 0
-    decompandedLUT = []
-    i = 0
-    for src_max in sorted(kneepoints.keys()):
+    sections = []
+    for i, src_max in enumerate(sorted(kneepoints.keys())):
         dst_max, compression = kneepoints[src_max]
-        for src in range(src_min, src_max+1):
-            decompanded = (src - src_min)*compression + dst_min
-            if decompanded>dst_max:
-                decompanded = dst_max
-            decompandedLUT.append(decompanded)
-        if DEBUG:
-            print("Decompanding section %d : SRC  %d  to %d  ---> DST: %d  to %d"%(i, src_min, src_max, dst_min, decompanded))
+        src = np.arange(src_min, src_max + 1)
+        decompanded = np.minimum((src - src_min)*compression + dst_min, dst_max)
+        sections.append(decompanded)
+        if DEBUG and len(decompanded) > 0:
+            print("Decompanding section %d : SRC  %d  to %d  ---> DST: %d  to %d"%(i, src_min, src_max, dst_min, decompanded[-1]))
         src_min = src_max+1
         dst_min = dst_max+1
-        i = i+1
-    return np.asarray(decompandedLUT,  dtype=np.uint16).reshape((len(decompandedLUT), ))
+    return np.concatenate(sections).astype(np.uint16)
@@ -0,0 +1,104 @@
+"""
+Shared bank of the lookup tables used for decompanding and tone mapping. Every LUT is built vectorized, memoized by its
+kneepoints for the lifetime of the process and returned read-only, so all users share one array. If a cache folder is
+set (LUT_CACHE_DIR environment variable or set_cache_dir) the tables are additionally persisted there as .npy files.
+"""
+import functools
+import hashlib
+import os
+
+import numpy as np
+
+from . import decompand
+
+_cache_dir = os.environ.get('LUT_CACHE_DIR')
+
+
+def set_cache_dir(path):
+    """Folder of the persisted LUTs, None disables persisting. Only affects LUTs which are not memoized yet."""
+    global _cache_dir
+    _cache_dir = path
+
+
+def build_lut_from_kneepoints(kneepoints, bit_depth=16, start_point=None):
+    """Piecewise linear LUT through start_point, the kneepoints and (2**bit_depth, 2**bit_depth), rounded down"""
+    if start_point is None:
+        start_point = [0, 0]
+    points = np.array([start_point] + [list(point) for point in kneepoints] + [[2**bit_depth, 2**bit_depth]],
+                      dtype=np.float64)
+    lut = np.floor(np.interp(np.arange(2**bit_depth), points[:, 0], points[:, 1]))
+    return lut.astype(np.uint16)
+
+
+def build_decompand_lut(kneepoints):
+    """Decompanding LUT of a kneepoint list as given in conversion_params, see decompand.loadKneepoints"""
+    return decompand.create_decompand_lut(decompand.loadKneepoints(kneepoints))
+
+
+def build_fused_lut(decompand_kneepoints, lut_kneepoints, input_bits=12, bit_depth=16):
+    """
+    Decompanding followed by the kneepoint LUT as one table over all 2**input_bits raw values. Raw values above the
+    last decompanding kneepoint are mapped like the last kneepoint.
+    """
+    decompand_lut = build_decompand_lut(decompand_kneepoints)
+    lut = build_lut_from_kneepoints(lut_kneepoints, bit_depth)
+    return lut[decompand_lut[np.minimum(np.arange(2**input_bits), len(decompand_lut) - 1)]]
+
+
+BUILDERS = {
+    'lut': lambda kneepoints, bit_depth, start_point, input_bits: build_lut_from_kneepoints(
+        kneepoints, bit_depth=bit_depth, start_point=start_point),
+    'decompand': lambda kneepoints, bit_depth, start_point, input_bits: build_decompand_lut(kneepoints),
+    'fused': lambda kneepoints, bit_depth, start_point, input_bits: build_fused_lut(
+        kneepoints[0], kneepoints[1], input_bits=input_bits, bit_depth=bit_depth),
+}
+
+
+def _to_tuple(points):
+    return tuple(tuple(int(value) for value in point) for point in points)
+
+
+def apply_lut(lut, image, out=None):
+    """Look up every pixel in one pass, indices beyond the table are clipped. out can be a reused uint16 buffer."""
+    return np.take(lut, image, mode='clip', out=out)
+
+
+def cache_path(kind, kneepoints, bit_depth, start_point, input_bits=None):
+    """<kind>[_in<input_bits>]_<bit_depth>_<hash>.npy, input_bits is only set for tables indexed by raw values"""
+    key = hashlib.sha1(repr((kind, kneepoints, bit_depth, start_point, input_bits)).encode('utf-8')).hexdigest()[:16]
+    name = kind if input_bits is None else '%s_in%d' % (kind, input_bits)
+    return os.path.join(_cache_dir, '%s_%d_%s.npy' % (name, bit_depth, key))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_lut(kind, kneepoints, bit_depth, start_point, input_bits=None):
+    path = cache_path(kind, kneepoints, bit_depth, start_point, input_bits) if _cache_dir else None
+    if path is not None and os.path.isfile(path):
+        lut = np.load(path)
+    else:
+        lut = BUILDERS[kind](kneepoints, bit_depth, start_point, input_bits)
+        if path is not None:
+            os.makedirs(_cache_dir, exist_ok=True)
+            # np.save appends .npy to names without it
+            tmp = path + '.tmp.npy'
+            np.save(tmp, lut)
+            os.replace(tmp, path)
+    lut.setflags(write=False)
+    return lut
+
+
+def get_lut(kneepoints, bit_depth=16, start_point=None):
+    """Memoized read-only version of build_lut_from_kneepoints"""
+    start_point = tuple(start_point) if start_point is not None else (0, 0)
+    return _get_lut('lut', _to_tuple(kneepoints), bit_depth, tuple(int(value) for value in start_point))
+
+
+def get_decompand_lut(kneepoints):
+    """Memoized read-only version of build_decompand_lut"""
+    return _get_lut('decompand', _to_tuple(kneepoints), 16, (0, 0))
+
+
+def get_fused_lut(decompand_kneepoints, lut_kneepoints, input_bits=12, bit_depth=16):
+    """Memoized read-only version of build_fused_lut"""
+    return _get_lut('fused', (_to_tuple(decompand_kneepoints), _to_tuple(lut_kneepoints)), bit_depth, (0, 0),
+                    input_bits=input_bits)
@@ -6,6 +6,8 @@ import math
 import copy
 import numpy
 
+from .rectification import get_rectification_maps
+
 def mkmat(rows, cols, L):
     mat = numpy.matrix(L, dtype='float64')
     mat.resize((rows,cols))
@@ -31,6 +33,10 @@ class PinholeCameraModel:
         self.raw_roi = None
         self.tf_frame = None
         self.stamp = None
+        self.map_type = 'float32'
+        self.calib_file = None
+        self.mapx = None
+        self.mapy = None
 
     def fromCameraInfo(self, msg):
         """
@@ -62,6 +68,8 @@ class PinholeCameraModel:
             self.raw_roi.height = self.height
         self.tf_frame = msg.header.frame_id
         self.stamp = msg.header.stamp
+        self.mapx = None
+        self.mapy = None
 
         # Adjust K and P for binning and ROI
         self.K[0,0] /= self.binning_x
@@ -97,6 +105,8 @@ class PinholeCameraModel:
             self.raw_roi['height'] = self.height
         self.tf_frame = loadeddict['header']['frame_id']
         self.stamp = loadeddict['header']['stamp']
+        self.mapx = None
+        self.mapy = None
 
         # Adjust K and P for binning and ROI
         self.K[0,0] /= self.binning_x
@@ -108,6 +118,18 @@ class PinholeCameraModel:
         self.P[0,2] = (self.P[0,2] - self.raw_roi['x_offset']) / self.binning_x
         self.P[1,2] = (self.P[1,2] - self.raw_roi['y_offset']) / self.binning_y
 
+    def setRectificationMaps(self, map_type='float32', calib_file=None):
+        """
+        :param map_type:   'float32' or the faster fixed-point 'fixed' (CV_16SC2) maps
+        :param calib_file: persist the maps next to this calibration file, see :mod:`rectification`
+
+        Selects the rectification maps used by :meth:`rectifyImage`, they are computed on first use.
+        """
+        self.map_type = map_type
+        self.calib_file = calib_file
+        self.mapx = None
+        self.mapy = None
+
     def rectifyImage(self, raw, rectified):
         """
         :param raw:       input image
@@ -116,14 +138,12 @@ class PinholeCameraModel:
         :type rectified:  :class:`CvMat` or :class:`IplImage`
 
         Applies the rectification specified by camera parameters :math:`K` and and :math:`D` to image `raw` and writes the resulting image `rectified`.
+        The rectification maps are computed once per calibration.
         """
 
-        self.mapx = numpy.ndarray(shape=(self.height, self.width, 1),
-                           dtype='float32')
-        self.mapy = numpy.ndarray(shape=(self.height, self.width, 1),
-                           dtype='float32')
-        cv2.initUndistortRectifyMap(self.K, self.D, self.R, self.P,
-                (self.width, self.height), cv2.CV_32FC1, self.mapx, self.mapy)
+        if self.mapx is None:
+            self.mapx, self.mapy = get_rectification_maps(self.K, self.D, self.R, self.P, (self.width, self.height),
+                                                          self.map_type, self.calib_file)
         cv2.remap(raw, self.mapx, self.mapy, cv2.INTER_AREA, rectified)
 
     def rectifyPoint(self, uv_raw):
@@ -1,8 +1,9 @@
 from conversion_lib.pinhole_camera_model import PinholeCameraModel
 from conversion_lib.basic_utils import read_image_intrinsic, read_tiff_image, save_tiff_image, check_image, read_meta_file, parse_day_night, apply_clahe_8bit
-import conversion_lib.decompand as decompand
+import conversion_lib.lut_bank as lut_bank
 import numpy as np
 import cv2
+import os
 
 
 def fb(x, bitdepth=16):
@@ -38,30 +39,9 @@ conversion_params = {
 
 
 def create_lut_from_kneepoints(kneepoints, bit_depth=16, start_point=None,DEBUG=False):
-    lut_kneepoints = kneepoints[:]
-    if start_point is None:
-        start_point = [0, 0]
-    end_point = [2**bit_depth, 2**bit_depth]
-    lut_kneepoints.append(end_point)
-    lut = np.zeros((2**bit_depth,), dtype=np.uint16)
-    counter = 0
-    for idx, kneepoint in enumerate(lut_kneepoints):
-        if counter == 0:
-            first_point = start_point
-            second_point = kneepoint
-        else:
-            first_point = lut_kneepoints[idx-1]
-            second_point = lut_kneepoints[idx]
-        counter += 1
-        if DEBUG:
-            print(first_point)
-            print(second_point)
-        m = (second_point[1] - first_point[1])/(float(second_point[0] - first_point[0]))
-        c = first_point[1] - m*first_point[0]
-
-        lut[first_point[0]:second_point[0]] = np.floor(m*np.arange(first_point[0],second_point[0]) + c).astype(np.uint16)
-
-    return lut
+    if DEBUG:
+        print(kneepoints)
+    return lut_bank.build_lut_from_kneepoints(kneepoints, bit_depth=bit_depth, start_point=start_point)
 
 def apply_clahe_8bit(image):
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
@@ -74,19 +54,32 @@ def apply_clahe_8bit(image):
 
     return image
 
+# products of Rectify_image.process_products, camera products are computed from debayered raw images, gated products
+# from single channel raw gated images
+CAMERA_PRODUCTS = ['lut', 'rect8', 'rect', 'rect_decompand']
+GATED_PRODUCTS = ['rect_gated', 'rect_lut_gated8']
+PRODUCTS = CAMERA_PRODUCTS + GATED_PRODUCTS
+
+
 class Rectify_image():
 
-    def __init__(self, root, cam_file, DEBUG=False):
+    def __init__(self, root, cam_file, DEBUG=False, map_type='float32', persist_maps=False):
         self.PC = PinholeCameraModel()
         self.data_camera = read_image_intrinsic(root, cam_file)
         self.PC.fromJsonDict(self.data_camera)
-        decompand_lut_kneepoints = decompand.loadKneepoints(conversion_params['decomp_kneepoints'])
-        compand_lut_kneepoints = decompand.loadKneepoints(conversion_params['comp_kneepoints'])
-        self.decompand_lut = decompand.create_decompand_lut(decompand_lut_kneepoints)
-        self.compand_lut = decompand.create_decompand_lut(compand_lut_kneepoints)
-        self.daytime_lut = create_lut_from_kneepoints(conversion_params["lut_kneepoints_daytime"])
-        self.nighttime_lut = create_lut_from_kneepoints(conversion_params["lut_kneepoints_nighttime"])
-        self.gated_lut = create_lut_from_kneepoints(conversion_params["lut_kneepoints_gated"], bit_depth=10)
+        self.PC.setRectificationMaps(map_type, os.path.join(root, cam_file) if persist_maps else None)
+        # the LUTs are shared by all instances, see lut_bank
+        self.decompand_lut = lut_bank.get_decompand_lut(conversion_params['decomp_kneepoints'])
+        self.compand_lut = lut_bank.get_decompand_lut(conversion_params['comp_kneepoints'])
+        self.daytime_lut = lut_bank.get_lut(conversion_params["lut_kneepoints_daytime"])
+        self.nighttime_lut = lut_bank.get_lut(conversion_params["lut_kneepoints_nighttime"])
+        self.gated_lut = lut_bank.get_lut(conversion_params["lut_kneepoints_gated"], bit_depth=10)
+        # decompanding and tone mapping of the 12 bit raw images fused into one 4096 entry table
+        self.daytime_fused_lut = lut_bank.get_fused_lut(conversion_params['decomp_kneepoints'],
+                                                        conversion_params["lut_kneepoints_daytime"])
+        self.nighttime_fused_lut = lut_bank.get_fused_lut(conversion_params['decomp_kneepoints'],
+                                                          conversion_params["lut_kneepoints_nighttime"])
+        self.lut_buffer = None
         self.DEBUG = DEBUG
 
     def process_lut(self, image_path, meta_path=None):
@@ -95,82 +88,86 @@ class Rectify_image():
         Images are applied with an hand crafted image enhancement process including a gamma correction and
         contrast enhancement. This approach reimplements the process for the images in cam_stereo_left_lut.
         """
-        image_raw = read_tiff_image(image_path)
-        if meta_path is not None:
-            meta = read_meta_file(meta_path)
-        else:
-            meta = None
-        if self.DEBUG:
-            check_image(image_raw)
-        image = self.decompand_lut[image_raw]
-
-        if parse_day_night(meta):
-            image_lut = self.daytime_lut[image]
-        else:
-            image_lut = self.nighttime_lut[image]
-        image_bayer = cv2.cvtColor(image_lut, cv2.COLOR_BAYER_GB2BGR)
-
-        image_bit = np.right_shift(image_bayer, 8).astype(np.uint8)
-        image_bit = apply_clahe_8bit(image_bit)
-        self.PC.rectifyImage(image_bit, image_bit)
-        return image_bit
+        return self.process_products(image_path, ['lut'], meta_path)['lut']
 
     def process_rect8(self, image_path):
         """
         Takes a raw data image and converts it to a 8 bit RGB image with for visual inspection.
         Images are only rectified and bitshifted.
         """
-        image_raw = read_tiff_image(image_path)
-        if self.DEBUG:
-            check_image(image_raw)
-        image_bayer = cv2.cvtColor(image_raw, cv2.COLOR_BAYER_GB2BGR)
-        self.PC.rectifyImage(image_bayer, image_bayer)
-        image_bit = np.right_shift(image_bayer, 4).astype(np.uint8)
-
-        return image_bit
+        return self.process_products(image_path, ['rect8'])['rect8']
 
     def process_rect(self, image_path):
         """
         Takes a raw data image and converts it to a rectified 12 bit RGB image
         """
-        image_raw = read_tiff_image(image_path)
-        if self.DEBUG:
-            check_image(image_raw)
-        image_bayer = cv2.cvtColor(image_raw, cv2.COLOR_BAYER_GB2BGR)
-        self.PC.rectifyImage(image_bayer, image_bayer)
-        return image_bayer
+        return self.process_products(image_path, ['rect'])['rect']
 
     def process_rect_decompand(self, image_path):
         """
         Takes a raw data image and converts it to a decompanded rectified 16 bit image.
         """
-        image_raw = read_tiff_image(image_path)
-        image_bayer = cv2.cvtColor(image_raw, cv2.COLOR_BAYER_GB2BGR)
-        self.PC.rectifyImage(image_bayer, image_bayer)
-        image_decomp = self.decompand_lut[image_bayer]
-        return image_decomp
+        return self.process_products(image_path, ['rect_decompand'])['rect_decompand']
 
     def process_rect_gated(self, image_path):
         """
         Takes a raw data gated image and converts it to a rectified 10 bit grayscale image
         """
-        image_raw = read_tiff_image(image_path)
-        if self.DEBUG:
-            check_image(image_raw)
-        self.PC.rectifyImage(image_raw, image_raw)
-        return image_raw
+        return self.process_products(image_path, ['rect_gated'])['rect_gated']
 
     def process_rect_lut_gated8(self, image_path):
         """
         Takes a raw data gated image and converts it to a rectified bit shifted 8 bit grayscale image
         """
+        return self.process_products(image_path, ['rect_lut_gated8'])['rect_lut_gated8']
+
+    def process_products(self, image_path, products, meta_path=None, day=None):
+        """
+        Reads the raw image once and returns a dict with the requested products, see PRODUCTS.
+        The rect, rect8 and rect_decompand products share one debayered and rectified image. The lut product applies
+        its LUTs before debayering and needs its own demosaic. Its day/night mode is taken from day if given, e.g. from
+        a metadata index, and read from meta_path otherwise.
+        """
         image_raw = read_tiff_image(image_path)
         if self.DEBUG:
             check_image(image_raw)
-        image_raw = self.gated_lut[image_raw]
-        image_raw = np.right_shift(image_raw, 2).astype(np.uint8)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        return clahe.apply(image_raw)
+        outputs = {}
+        if 'lut' in products:
+            if day is None:
+                day = parse_day_night(read_meta_file(meta_path) if meta_path is not None else None)
+            outputs['lut'] = self.lut_from_raw(image_raw, day)
+        if any(product in products for product in ['rect8', 'rect', 'rect_decompand']):
+            image_bayer = cv2.cvtColor(image_raw, cv2.COLOR_BAYER_GB2BGR)
+            self.PC.rectifyImage(image_bayer, image_bayer)
+            if 'rect8' in products:
+                outputs['rect8'] = np.right_shift(image_bayer, 4).astype(np.uint8)
+            if 'rect_decompand' in products:
+                outputs['rect_decompand'] = self.decompand_lut[image_bayer]
+            if 'rect' in products:
+                outputs['rect'] = image_bayer
+        if 'rect_lut_gated8' in products:
+            image_lut = np.right_shift(self.gated_lut[image_raw], 2).astype(np.uint8)
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+            outputs['rect_lut_gated8'] = clahe.apply(image_lut)
+        if 'rect_gated' in products:
+            self.PC.rectifyImage(image_raw, image_raw)
+            outputs['rect_gated'] = image_raw
+        return outputs
+
+    def lut_from_raw(self, image_raw, day=True):
+        if self.lut_buffer is None or self.lut_buffer.shape != image_raw.shape:
+            self.lut_buffer = np.empty(image_raw.shape, dtype=np.uint16)
+
+        if day:
+            image_lut = lut_bank.apply_lut(self.daytime_fused_lut, image_raw, out=self.lut_buffer)
+        else:
+            image_lut = lut_bank.apply_lut(self.nighttime_fused_lut, image_raw, out=self.lut_buffer)
+        image_bayer = cv2.cvtColor(image_lut, cv2.COLOR_BAYER_GB2BGR)
+
+        image_bit = np.right_shift(image_bayer, 8).astype(np.uint8)
+        image_bit = apply_clahe_8bit(image_bit)
+        self.PC.rectifyImage(image_bit, image_bit)
+        return image_bit
 
     def process_comp(self, image):
         return self.compand_lut[image]
\ No newline at end of file
@@ -0,0 +1,65 @@
+"""
+Cache of the undistortion and rectification maps of cv2.initUndistortRectifyMap. The maps depend only on the calibration,
+so they are computed once per calibration and map type and shared by all camera models of a process. Optionally they
+are persisted as .npz next to the calibration file. 'float32' maps reproduce the original per-image computation
+exactly, 'fixed' maps use the fixed-point CV_16SC2 format (1/32 pixel interpolation table) which remaps faster.
+"""
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+MAP_TYPES = {'float32': cv2.CV_32FC1, 'fixed': cv2.CV_16SC2}
+
+_maps = {}
+
+
+def calibration_key(K, D, R, P, size, map_type):
+    """Hash of everything the maps depend on"""
+    key = hashlib.sha1()
+    for matrix in [K, D, R, P]:
+        if matrix is None:
+            key.update(b'None')
+        else:
+            matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+            key.update(str(matrix.shape).encode('utf-8'))
+            key.update(matrix.tobytes())
+    key.update(('%d_%d_%s' % (size[0], size[1], map_type)).encode('utf-8'))
+    return key.hexdigest()
+
+
+def rectification_cache_path(calib_file, map_type):
+    return os.path.splitext(calib_file)[0] + '_rectify_%s.npz' % map_type
+
+
+def compute_rectification_maps(K, D, R, P, size, map_type='float32'):
+    return cv2.initUndistortRectifyMap(np.asarray(K), None if D is None else np.asarray(D), np.asarray(R),
+                                       np.asarray(P), size, MAP_TYPES[map_type])
+
+
+def get_rectification_maps(K, D, R, P, size, map_type='float32', calib_file=None):
+    """
+    Return the read-only (map1, map2) pair for cv2.remap of a calibration, size is (width, height).
+    With calib_file the maps are loaded from and written to rectification_cache_path(calib_file, map_type).
+    """
+    key = calibration_key(K, D, R, P, size, map_type)
+    if key in _maps:
+        return _maps[key]
+    maps = None
+    path = rectification_cache_path(calib_file, map_type) if calib_file is not None else None
+    if path is not None and os.path.isfile(path):
+        with np.load(path) as data:
+            # a changed calibration invalidates the persisted maps
+            if str(data['key']) == key:
+                maps = (data['map1'], data['map2'])
+    if maps is None:
+        maps = compute_rectification_maps(K, D, R, P, size, map_type)
+        if path is not None:
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, key=key, map1=maps[0], map2=maps[1])
+            os.replace(path + '.tmp', path)
+    for rectification_map in maps:
+        rectification_map.setflags(write=False)
+    _maps[key] = maps
+    return maps
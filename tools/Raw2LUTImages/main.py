@@ -1,23 +1,121 @@
 import numpy as np
 import os
+import time
 import argparse
+import multiprocessing
 from conversion_lib.plot_utils import PlotLut
-from conversion_lib.process import Rectify_image, conversion_params
+from conversion_lib.process import Rectify_image, conversion_params, PRODUCTS
 import cv2
 
+# output folder suffix and file extension of every product, e.g. cam_stereo_left -> cam_stereo_left_lut. The gated
+# products use the folder names of the dataset (gated_full_rect, gated_full_rect8) and can not be combined with the
+# camera products of the same suffix.
+PRODUCT_OUTPUTS = {
+    'lut': ('lut', '.png'),
+    'rect8': ('rect8', '.png'),
+    'rect': ('rect', '.tiff'),
+    'rect_decompand': ('rect_decompand', '.tiff'),
+    'rect_gated': ('rect', '.tiff'),
+    'rect_lut_gated8': ('rect8', '.png'),
+}
+
+
 def parsArgs():
     parser = argparse.ArgumentParser(description='RawData Converter')
     parser.add_argument('--root', '-r', help='Enter the root folder', default='./example_data/')
     parser.add_argument('--cam_file', '-c', help='Enter the root folder', default='calib_cam_stereo_left.json')
     parser.add_argument('--image_folder', '-i', help='Data folder Images', default='cam_stereo_left')
     parser.add_argument('--meta_folder', '-m', help='Enter the fog density beta', default='labeltool_labels')
-    parser.add_argument('--dest_folder', '-d', help='Enter the fog density beta', default='cam_stereo_left_lut')
+    parser.add_argument('--dest_folder', '-d', help='Destination folder of the lut product, defaults to <image_folder>_lut', default=None)
+    parser.add_argument('--products', '-p', nargs='+', choices=PRODUCTS, help='Products written from one read of every raw image', default=['lut'])
+    parser.add_argument('--workers', '-w', type=int, help='Number of worker processes, 1 disables the pool', default=multiprocessing.cpu_count() - 1 or 1)
+    parser.add_argument('--overwrite', action='store_true', help='Recompute outputs which are newer than their raw image')
+    parser.add_argument('--metadata_index', help='Metadata index with the daytime of the samples (see DatasetViewer/create_metadata_index.py), replaces reading the meta folder', default=None)
     parser.add_argument('--DEBUG', '-D', help='Enter the fog density beta', default=False)
     args = parser.parse_args()
-    global hazed
+    suffixes = {}
+    for product in args.products:
+        suffix = PRODUCT_OUTPUTS[product][0]
+        if suffixes.setdefault(suffix, product) != product:
+            parser.error('products %s and %s are both written to %s_%s' % (suffixes[suffix], product,
+                                                                          args.image_folder, suffix))
 
     return args
 
+
+def destination_folders(args):
+    folders = {}
+    for product in args.products:
+        suffix, _ = PRODUCT_OUTPUTS[product]
+        folders[product] = os.path.join(args.root, args.image_folder + '_' + suffix)
+    if args.dest_folder is not None and 'lut' in folders:
+        folders['lut'] = os.path.join(args.root, args.dest_folder)
+    return folders
+
+
+def write_image(path, image):
+    """Write through a temporary file, an interrupted write must not leave an output that looks up to date"""
+    success, buffer = cv2.imencode(os.path.splitext(path)[1], image)
+    if not success:
+        raise IOError('Could not encode %s' % path)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(buffer.tobytes())
+    os.replace(path + '.tmp', path)
+
+
+def is_up_to_date(output_path, input_paths):
+    """An output is up to date if it is not older than any of its existing inputs"""
+    if not os.path.isfile(output_path):
+        return False
+    output_time = os.path.getmtime(output_path)
+    return all(output_time >= os.path.getmtime(path) for path in input_paths if os.path.isfile(path))
+
+
+_converter = None
+
+
+def _init_worker(args):
+    global _converter
+    _converter = Converter(args)
+
+
+def convert_file(sample):
+    return _converter(sample)
+
+
+class Converter():
+    """Writes the selected products of one raw image, outputs which are up to date are skipped"""
+
+    def __init__(self, args):
+        self.args = args
+        self.RI = Rectify_image(args.root, args.cam_file)
+        self.folders = destination_folders(args)
+        self.metadata_index = None
+        if args.metadata_index is not None:
+            # needs the repository root in the PYTHONPATH
+            from tools.DatasetViewer.lib.metadata import open_metadata_index
+            self.metadata_index = open_metadata_index(args.metadata_index)
+
+    def __call__(self, sample):
+        args = self.args
+        image_path = os.path.join(args.root, args.image_folder, sample)
+        meta_path = os.path.join(args.root, args.meta_folder, sample.replace('.tiff', '.json'))
+        outputs = {}
+        for product, folder in self.folders.items():
+            outputs[product] = os.path.join(folder, os.path.splitext(sample)[0] + PRODUCT_OUTPUTS[product][1])
+        todo = [product for product in outputs if args.overwrite or not is_up_to_date(
+            outputs[product], [image_path, meta_path] if product == 'lut' else [image_path])]
+        if not todo:
+            return 0
+        day = None
+        if self.metadata_index is not None:
+            day = self.metadata_index.get(os.path.splitext(sample)[0], 'label/day')
+        images = self.RI.process_products(image_path, todo, meta_path if os.path.isfile(meta_path) else None, day)
+        for product in todo:
+            write_image(outputs[product], images[product])
+        return len(todo)
+
+
 if __name__ == '__main__':
 
     args = parsArgs()
@@ -25,13 +123,31 @@ if __name__ == '__main__':
         p = PlotLut()
         p.add_plot(conversion_params["decomp_kneepoints"])
         p.show_plot()
-    RI = Rectify_image(args.root, args.cam_file)
-    if not os.path.exists(os.path.join(args.root, args.dest_folder)):
-        os.makedirs(os.path.join(args.root, args.dest_folder))
+    for folder in destination_folders(args).values():
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    samples = sorted(sample for sample in os.listdir(os.path.join(args.root, args.image_folder)) if sample.endswith('.tiff'))
+    print('converting %d images to %s with %d workers' % (len(samples), ', '.join(args.products), args.workers))
 
-    for sample in os.listdir(os.path.join(args.root, args.image_folder)):
-        image_lut = RI.process_lut(os.path.join(args.root, args.image_folder, sample), os.path.join(args.root, args.meta_folder, sample.replace('.tiff', '.json')))
+    start = time.time()
+    if args.workers > 1:
+        pool = multiprocessing.Pool(processes=args.workers, initializer=_init_worker, initargs=(args,))
+        results = pool.imap_unordered(convert_file, samples, chunksize=max(1, len(samples) // (4 * args.workers)))
+    else:
+        pool = None
+        _init_worker(args)
+        results = map(convert_file, samples)
 
+    n_written = 0
+    for idx, written in enumerate(results):
+        n_written += written
+        if (idx + 1) % 100 == 0:
+            print('Processed %d/%d images' % (idx + 1, len(samples)))
 
-        cv2.imwrite(os.path.join(args.root, args.dest_folder, sample.replace('.tiff', '.png')), image_lut)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
+    elapsed = time.time() - start
+    print('elapsed_time %.2fs, wrote %d outputs for %d images' % (elapsed, n_written, len(samples)))